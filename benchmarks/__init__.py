@@ -0,0 +1,119 @@
+"""
+Micro benchmarks for mongodbforms.
+
+Most benchmarks don't need a running MongoDB. Run a single suite with::
+
+    python -m benchmarks.bench_documentoptions
+
+Suites that hit the database use mongomock if it is installed, otherwise
+the MongoDB at ``MONGODB_BENCHMARK_URI`` (default: a local ``mongod``). See
+``connect``.
+
+Numbers are the best of several runs in microseconds per operation.
+"""
+import json
+import os
+import platform
+import subprocess
+import timeit
+
+from django.conf import settings
+
+if not settings.configured:
+    settings.configure(
+        DEBUG=False,
+        INSTALLED_APPS=(
+            'django.contrib.contenttypes',
+            'django.contrib.auth',
+        )
+    )
+    try:
+        from django import setup
+    except ImportError:
+        # Django < 1.7
+        pass
+    else:
+        setup()
+
+
+def measure(func, number=10000, repeat=5):
+    """Returns the best time for a single call of ``func`` in usec."""
+    timer = timeit.Timer(func)
+    return min(timer.repeat(repeat=repeat, number=number)) / number * 1e6
+
+
+def run(benchmarks, number=10000, repeat=5):
+    """
+    Runs a list of ``(name, func)`` benchmarks and prints the results.
+    Returns a dict mapping the names to usec per call.
+    """
+    results = {}
+    for name, func in benchmarks:
+        results[name] = measure(func, number, repeat)
+        print('%-40s %10.3f usec' % (name, results[name]))
+    return results
+
+
+def connect(db='mongodbforms_benchmarks'):
+    """
+    Connects mongoengine for the suites that need a database. Uses mongomock
+    if it is installed, unless ``MONGODB_BENCHMARK_URI`` is set. Returns the
+    name of the backend.
+    """
+    import mongoengine
+
+    uri = os.environ.get('MONGODB_BENCHMARK_URI')
+    if uri is None:
+        try:
+            import mongomock
+        except ImportError:
+            uri = 'mongodb://localhost:27017/%s' % db
+        else:
+            try:
+                from mongomock.gridfs import enable_gridfs_integration
+            except ImportError:
+                # gridfs benchmarks will fail with old mongomock versions
+                pass
+            else:
+                enable_gridfs_integration()
+            mongoengine.connect(db, host='mongodb://localhost',
+                                mongo_client_class=mongomock.MongoClient)
+            return 'mongomock'
+    mongoengine.connect(db, host=uri)
+    return 'mongod'
+
+
+def environment():
+    """Returns the versions and git commit the results were measured with."""
+    import django
+    import mongoengine
+
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    try:
+        commit = subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'], cwd=root,
+            stderr=subprocess.STDOUT).decode('utf-8').strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+        'commit': commit,
+        'python': platform.python_version(),
+        'implementation': platform.python_implementation(),
+        'django': django.get_version(),
+        'mongoengine': mongoengine.get_version(),
+    }
+
+
+def write_results(results, path, **extra):
+    """
+    Writes ``results`` (a dict mapping benchmark names to usec per call) to
+    ``path`` as JSON, together with the environment.
+    Compare two result files with ``python -m benchmarks.compare``.
+    """
+    data = environment()
+    data.update(extra)
+    data['unit'] = 'usec'
+    data['results'] = results
+    output = json.dumps(data, indent=2, sort_keys=True)
+    with open(path, 'w') as f:
+        f.write(output + '\n')
@@ -0,0 +1,42 @@
+"""
+Attribute access on ``DocumentMetaWrapper``. These are hit for every row of
+every changelist in the admin.
+"""
+import benchmarks  # noqa: configures Django
+
+import mongoengine
+
+from mongodbforms.documentoptions import DocumentMetaWrapper
+
+
+class BenchDocument(mongoengine.Document):
+    meta = {'app_label': 'benchmarks'}
+
+    name = mongoengine.StringField()
+    title = mongoengine.StringField(max_length=100)
+    count = mongoengine.IntField()
+
+
+class BenchEmbeddedDocument(mongoengine.EmbeddedDocument):
+    name = mongoengine.StringField()
+
+
+def get_benchmarks():
+    meta = DocumentMetaWrapper(BenchDocument)
+    embedded_meta = DocumentMetaWrapper(BenchEmbeddedDocument)
+    return [
+        ('pk.name', lambda: meta.pk.name),
+        ('pk.attname', lambda: meta.pk.attname),
+        ('pk.editable', lambda: meta.pk.editable),
+        ('pk.<field attribute>', lambda: meta.pk.required),
+        ('embedded pk.editable', lambda: embedded_meta.pk.editable),
+        ('get_field', lambda: meta.get_field('title')),
+        ('get_fields', lambda: meta.get_fields()),
+        ('hasattr miss', lambda: hasattr(meta, 'no_such_option')),
+        ('verbose_name', lambda: meta.verbose_name),
+        ('app_label', lambda: meta.app_label),
+    ]
+
+
+if __name__ == '__main__':
+    benchmarks.run(get_benchmarks())
@@ -0,0 +1,45 @@
+"""
+Form instantiation: creates forms for a document with 50 fields of mixed
+types, including container fields. No database is needed, the document
+has no reference fields.
+"""
+import benchmarks  # noqa: configures Django
+
+import mongoengine
+
+from mongodbforms import documentform_factory
+
+FIELD_COUNT = 50
+FORM_COUNT = 1000
+
+
+def make_document(field_count=FIELD_COUNT):
+    field_types = [
+        lambda: mongoengine.StringField(max_length=100),
+        lambda: mongoengine.StringField(),
+        lambda: mongoengine.IntField(min_value=0),
+        lambda: mongoengine.FloatField(),
+        lambda: mongoengine.BooleanField(),
+        lambda: mongoengine.StringField(choices=[(str(i), str(i))
+                                                 for i in range(20)]),
+        lambda: mongoengine.ListField(mongoengine.StringField()),
+        lambda: mongoengine.MapField(mongoengine.IntField()),
+        lambda: mongoengine.EmailField(),
+        lambda: mongoengine.DateTimeField(),
+    ]
+    attrs = {'meta': {'app_label': 'benchmarks'}}
+    for i in range(field_count):
+        attrs['field_%s' % i] = field_types[i % len(field_types)]()
+    return type('BenchFormDocument', (mongoengine.Document, ), attrs)
+
+
+def get_benchmarks():
+    document = make_document()
+    form_class = documentform_factory(document)
+    return [
+        ('instantiate %s field form' % FIELD_COUNT, lambda: form_class()),
+    ]
+
+
+if __name__ == '__main__':
+    benchmarks.run(get_benchmarks(), number=FORM_COUNT)
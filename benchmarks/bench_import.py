@@ -0,0 +1,67 @@
+"""
+Import time of mongodbforms measured with ``python -X importtime``.
+
+Exits with status 1 if ``import mongodbforms`` takes longer than the budget
+(in msec), so it can be used in CI::
+
+    python -m benchmarks.bench_import [budget]
+"""
+import os
+import subprocess
+import sys
+
+# msec for a bare ``import mongodbforms``. The package imports its modules
+# lazily, so this shouldn't include Django or mongoengine.
+IMPORT_BUDGET = 20.0
+
+SETUP = ("from django.conf import settings; settings.configure(); "
+         "import django; django.setup(); ")
+
+STATEMENTS = (
+    ('import mongodbforms', 'import mongodbforms', 'mongodbforms'),
+    ('mongodbforms.DocumentForm',
+     SETUP + 'import mongodbforms; mongodbforms.DocumentForm',
+     'mongodbforms.documents'),
+)
+
+
+def import_time(statement, module, runs=5):
+    """
+    Returns the best cumulative import time of ``module`` in msec while
+    running ``statement`` in a fresh interpreter.
+    """
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join(
+        [root] + [p for p in [env.get('PYTHONPATH')] if p])
+    best = None
+    for i in range(runs):
+        output = subprocess.check_output(
+            [sys.executable, '-X', 'importtime', '-c', statement],
+            stderr=subprocess.STDOUT, env=env, cwd=root,
+        ).decode('utf-8')
+        for line in output.splitlines():
+            if not line.startswith('import time:'):
+                continue
+            parts = [p.strip() for p in line[len('import time:'):].split('|')]
+            if parts[-1] == module:
+                value = int(parts[1]) / 1000.0
+                best = value if best is None else min(best, value)
+    return best
+
+
+def run(budget=IMPORT_BUDGET):
+    results = {}
+    for name, statement, module in STATEMENTS:
+        results[name] = import_time(statement, module)
+        print('%-40s %10.3f msec' % (name, results[name]))
+    if results['import mongodbforms'] > budget:
+        print('import mongodbforms exceeds the budget of %.1f msec' % budget)
+        return results, False
+    return results, True
+
+
+if __name__ == '__main__':
+    budget = float(sys.argv[1]) if len(sys.argv) > 1 else IMPORT_BUDGET
+    results, ok = run(budget)
+    sys.exit(0 if ok else 1)
@@ -0,0 +1,323 @@
+"""
+Form lifecycle against a database: form class creation, instantiation,
+binding and validation, saving, formsets of 10/100/1000 rows, embedded
+formsets over a large list, container field render/parse, map key
+validation after many form class constructions and GridFS uploads.
+
+Runs against mongomock or a local ``mongod`` (see ``benchmarks.connect``)
+and can write the results as JSON to compare them between commits::
+
+    python -m benchmarks.bench_lifecycle --json before.json
+    git checkout ...
+    python -m benchmarks.bench_lifecycle --json after.json
+    python -m benchmarks.compare before.json after.json
+"""
+import argparse
+import itertools
+
+import benchmarks
+
+import mongoengine
+
+from django import forms
+from django.core.files.uploadedfile import SimpleUploadedFile
+
+from mongodbforms import (documentform_factory, documentformset_factory,
+                          embeddedformset_factory)
+from mongodbforms import documents
+from mongodbforms.fields import ListField, MapField
+
+FORMSET_ROWS = (10, 100, 1000)
+EMBEDDED_ROWS = 1000
+CONTAINER_SIZE = 100
+MAP_CONSTRUCTIONS = 10000
+
+
+class BenchAuthor(mongoengine.Document):
+    name = mongoengine.StringField(max_length=100, required=True)
+    email = mongoengine.EmailField()
+    age = mongoengine.IntField(min_value=0)
+    bio = mongoengine.StringField()
+    tags = mongoengine.ListField(mongoengine.StringField())
+    ratings = mongoengine.MapField(mongoengine.IntField())
+
+    meta = {'app_label': 'benchmarks'}
+
+
+class BenchItem(mongoengine.EmbeddedDocument):
+    name = mongoengine.StringField(max_length=100)
+    quantity = mongoengine.IntField()
+    price = mongoengine.FloatField()
+
+    meta = {'app_label': 'benchmarks'}
+
+
+class BenchOrder(mongoengine.Document):
+    number = mongoengine.StringField()
+    items = mongoengine.ListField(mongoengine.EmbeddedDocumentField(BenchItem))
+
+    meta = {'app_label': 'benchmarks'}
+
+
+class BenchAttachment(mongoengine.Document):
+    title = mongoengine.StringField()
+    upload = mongoengine.FileField()
+
+    meta = {'app_label': 'benchmarks'}
+
+
+def author_data(prefix=None, tags=3):
+    data = {
+        'name': 'Douglas Adams',
+        'email': 'douglas@example.com',
+        'age': '49',
+        'bio': 'Wrote about towels.',
+        'ratings_key_0': 'style',
+        'ratings_value_0': '5',
+    }
+    for i in range(tags):
+        data['tags_%s' % i] = 'tag%s' % i
+    if prefix is not None:
+        data = dict(('%s-%s' % (prefix, k), v) for k, v in data.items())
+    return data
+
+
+def formset_data(rows, prefix='form', initial=0, row_data=author_data):
+    data = {
+        '%s-TOTAL_FORMS' % prefix: str(rows),
+        '%s-INITIAL_FORMS' % prefix: str(initial),
+        '%s-MAX_NUM_FORMS' % prefix: '',
+    }
+    for i in range(rows):
+        data.update(row_data('%s-%s' % (prefix, i)))
+    return data
+
+
+def item_data(prefix):
+    return {
+        '%s-name' % prefix: 'towel',
+        '%s-quantity' % prefix: '1',
+        '%s-price' % prefix: '4.2',
+    }
+
+
+def form_benchmarks():
+    form_class = documentform_factory(BenchAuthor)
+    data = author_data()
+
+    def build_class():
+        documents._form_classes.clear()
+        documentform_factory(BenchAuthor)
+
+    def bind_and_validate():
+        form_class(data).is_valid()
+
+    def save():
+        form = form_class(data)
+        form.is_valid()
+        form.save()
+
+    return [
+        ('form class creation', build_class, 1000),
+        ('form class creation (cached)',
+         lambda: documentform_factory(BenchAuthor), 10000),
+        ('form instantiation', lambda: form_class(), 10000),
+        ('form bind and validate', bind_and_validate, 1000),
+        ('form save', save, 200),
+    ]
+
+
+def formset_benchmarks(rows=FORMSET_ROWS):
+    formset_class = documentformset_factory(BenchAuthor, extra=0)
+    results = []
+    for count in rows:
+        data = formset_data(count)
+        number = max(1, 1000 // count)
+
+        def bind_and_validate(data=data):
+            formset_class(data).is_valid()
+
+        def save(data=data):
+            formset = formset_class(data)
+            formset.is_valid()
+            formset.save()
+
+        results.extend([
+            ('formset of %s bind and validate' % count,
+             bind_and_validate, number),
+            ('formset of %s save' % count, save, number),
+        ])
+    return results
+
+
+def embedded_formset_benchmarks(rows=EMBEDDED_ROWS):
+    order = BenchOrder(number='42')
+    order.items = [BenchItem(name='item %s' % i, quantity=i, price=1.0)
+                   for i in range(rows)]
+    order.save()
+    formset_class = embeddedformset_factory(BenchItem, BenchOrder, extra=0)
+    prefix = formset_class.get_default_prefix()
+    data = formset_data(rows, prefix=prefix, initial=rows,
+                        row_data=item_data)
+    number = max(1, 1000 // rows)
+
+    def instantiate():
+        formset_class(parent_document=order).forms
+
+    def bind_and_validate():
+        formset_class(data, parent_document=order).is_valid()
+
+    return [
+        ('embedded formset of %s rows' % rows, instantiate, number),
+        ('embedded formset of %s bind and validate' % rows,
+         bind_and_validate, number),
+    ]
+
+
+def container_benchmarks(size=CONTAINER_SIZE):
+    form_class = documentform_factory(BenchAuthor)
+    list_field = form_class.base_fields['tags']
+    map_field = form_class.base_fields['ratings']
+    assert isinstance(list_field, ListField)
+    assert isinstance(map_field, MapField)
+
+    values = ['value %s' % i for i in range(size)]
+    mapping = dict(('key%s' % i, i) for i in range(size))
+    list_data = dict(('tags_%s' % i, v) for i, v in enumerate(values))
+    map_data = {}
+    for i, (key, value) in enumerate(mapping.items()):
+        map_data['ratings_key_%s' % i] = key
+        map_data['ratings_value_%s' % i] = str(value)
+
+    def parse_list():
+        list_field.clean(
+            list_field.widget.value_from_datadict(list_data, {}, 'tags'))
+
+    def parse_map():
+        map_field.clean(
+            map_field.widget.value_from_datadict(map_data, {}, 'ratings'))
+
+    return [
+        # ListWidget.render appends to the list it gets, so pass a copy
+        ('list field of %s render' % size,
+         lambda: list_field.widget.render('tags', list(values),
+                                          {'id': 'id_tags'}), 100),
+        ('list field of %s parse' % size, parse_list, 1000),
+        ('map field of %s render' % size,
+         lambda: map_field.widget.render('ratings', mapping,
+                                         {'id': 'id_ratings'}), 100),
+        ('map field of %s parse' % size, parse_map, 1000),
+    ]
+
+
+def map_key_benchmarks(constructions=MAP_CONSTRUCTIONS, size=CONTAINER_SIZE):
+    """
+    Key validation before and after building many form classes with a
+    length limited map field. The cost must not grow with the number of
+    form classes built before.
+    """
+    def build_form_class():
+        return type('RatingsForm', (forms.Form, ), {
+            'ratings': MapField(forms.IntegerField, max_key_length=20),
+        })
+
+    mapping = dict(('key%s' % i, str(i)) for i in range(size))
+
+    def validate_keys():
+        build_form_class().base_fields['ratings'].clean(mapping)
+
+    def build_form_classes():
+        for i in range(constructions):
+            build_form_class()
+
+    return [
+        ('map key validation of %s' % size, validate_keys, 100),
+        ('%s map form class constructions' % constructions,
+         build_form_classes, 1),
+        ('map key validation of %s after constructions' % size,
+         validate_keys, 100),
+    ]
+
+
+def gridfs_benchmarks(size=64 * 1024):
+    form_class = documentform_factory(BenchAttachment)
+    content = b'x' * size
+    # unique names, otherwise this would measure the search for a free
+    # file name in _get_unique_filename
+    names = ('upload%s.txt' % i for i in itertools.count())
+
+    def upload():
+        upload = SimpleUploadedFile(next(names), content,
+                                    content_type='text/plain')
+        form = form_class({'title': 'upload'}, {'upload': upload})
+        form.is_valid()
+        form.save()
+
+    return [
+        ('gridfs upload of %s kB' % (size // 1024), upload, 100),
+    ]
+
+
+SUITES = (
+    ('form', form_benchmarks),
+    ('formset', formset_benchmarks),
+    ('embedded', embedded_formset_benchmarks),
+    ('container', container_benchmarks),
+    ('mapkeys', map_key_benchmarks),
+    ('gridfs', gridfs_benchmarks),
+)
+
+
+def drop_collections():
+    for document in (BenchAuthor, BenchOrder, BenchAttachment):
+        document.drop_collection()
+    db = mongoengine.connection.get_db()
+    for name in ('fs.files', 'fs.chunks'):
+        db.drop_collection(name)
+
+
+def run(suites=None, repeat=3, scale=1.0):
+    """
+    Runs the named suites (all by default) and returns a dict mapping the
+    benchmark names to usec per call. ``scale`` multiplies the number of
+    calls per run.
+    """
+    results = {}
+    drop_collections()
+    try:
+        for name, get_benchmarks in SUITES:
+            if suites and name not in suites:
+                continue
+            for bench_name, func, number in get_benchmarks():
+                number = max(1, int(number * scale))
+                results[bench_name] = benchmarks.measure(func, number, repeat)
+                print('%-45s %12.3f usec' % (bench_name,
+                                             results[bench_name]))
+    finally:
+        drop_collections()
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--json', metavar='PATH',
+                        help='write the results as JSON to PATH')
+    parser.add_argument('--suite', action='append',
+                        choices=[name for name, func in SUITES],
+                        help='only run this suite, can be repeated')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='runs per benchmark, the best is reported')
+    parser.add_argument('--scale', type=float, default=1.0,
+                        help='multiplies the number of calls per run')
+    args = parser.parse_args(argv)
+
+    backend = benchmarks.connect()
+    print('backend: %s' % backend)
+    results = run(args.suite, args.repeat, args.scale)
+    if args.json:
+        benchmarks.write_results(results, args.json, backend=backend,
+                                 suite='lifecycle')
+
+
+if __name__ == '__main__':
+    main()
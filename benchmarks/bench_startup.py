@@ -0,0 +1,62 @@
+"""
+Startup cost of wrapping a large schema: defines 300 documents with a mix
+of plain, choice (short and long lists) and reference fields and builds the
+DocumentMetaWrapper of every document.
+"""
+import time
+
+import benchmarks  # noqa: configures Django
+
+import mongoengine
+
+from mongodbforms.documentoptions import (get_document_meta,
+                                          clear_document_meta_registry)
+
+DOCUMENT_COUNT = 300
+
+CHOICES = (('a', 'A'), ('Group', (('b', 'B'), ('c', 'C'))))
+# a long list like country codes
+LONG_CHOICES = tuple(('c%s' % i, 'Choice %s' % i) for i in range(250))
+
+
+def make_schema(prefix, count=DOCUMENT_COUNT):
+    documents = []
+    for i in range(count):
+        attrs = {
+            'meta': {'app_label': 'benchmarks'},
+            'firstName': mongoengine.StringField(max_length=100),
+            'last_name': mongoengine.StringField(),
+            'status': mongoengine.StringField(choices=CHOICES),
+            'country': mongoengine.StringField(choices=LONG_CHOICES),
+            'counter': mongoengine.IntField(),
+            'tags': mongoengine.ListField(mongoengine.StringField()),
+        }
+        if documents:
+            attrs['parent'] = mongoengine.ReferenceField(documents[-1])
+            attrs['related'] = mongoengine.ListField(
+                mongoengine.ReferenceField(documents[0]))
+        name = '%sDocument%s' % (prefix, i)
+        documents.append(type(name, (mongoengine.Document, ), attrs))
+    return documents
+
+
+def run(repeat=3):
+    results = {}
+    for i in range(repeat):
+        start = time.time()
+        documents = make_schema('Startup%s' % i)
+        defined = time.time()
+        for document in documents:
+            get_document_meta(document)
+        wrapped = time.time()
+        clear_document_meta_registry()
+        for name, value in (('define schema', defined - start),
+                            ('wrap schema', wrapped - defined)):
+            results[name] = min(results.get(name, value), value)
+    for name, value in sorted(results.items()):
+        print('%-40s %10.3f msec' % (name, value * 1000))
+    return results
+
+
+if __name__ == '__main__':
+    run()
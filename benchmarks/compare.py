@@ -0,0 +1,51 @@
+"""
+Compares two JSON result files written by the benchmark suites::
+
+    python -m benchmarks.compare before.json after.json [threshold]
+
+Prints the change of every benchmark and exits with status 1 if one got
+slower by more than ``threshold`` percent (default: 10).
+"""
+import json
+import sys
+
+THRESHOLD = 10.0
+
+
+def load(path):
+    with open(path) as f:
+        return json.load(f)
+
+
+def compare(before, after, threshold=THRESHOLD):
+    """
+    Prints the changes between two result dicts. Returns the names of the
+    benchmarks that got slower by more than ``threshold`` percent.
+    """
+    print('%-45s %12s %12s %8s' % ('', (before.get('commit') or '')[:10],
+                                   (after.get('commit') or '')[:10], ''))
+    regressions = []
+    old, new = before['results'], after['results']
+    for name in sorted(set(old) | set(new)):
+        if name not in old or name not in new:
+            print('%-45s %12s %12s' % (name, '%.3f' % old[name]
+                                       if name in old else '-',
+                                       '%.3f' % new[name]
+                                       if name in new else '-'))
+            continue
+        change = (new[name] - old[name]) / old[name] * 100
+        flag = ''
+        if change > threshold:
+            regressions.append(name)
+            flag = ' slower'
+        print('%-45s %12.3f %12.3f %+7.1f%%%s' % (name, old[name], new[name],
+                                                  change, flag))
+    return regressions
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 3:
+        sys.exit(__doc__)
+    threshold = float(sys.argv[3]) if len(sys.argv) > 3 else THRESHOLD
+    regressions = compare(load(sys.argv[1]), load(sys.argv[2]), threshold)
+    sys.exit(1 if regressions else 0)
@@ -1,4 +1,82 @@
-from django.forms.fields import *
-from .documents import *
-from .fieldgenerator import *
-from .util import *
+import sys
+
+if sys.version_info < (3, 7):
+    from django.forms.fields import *
+    from .documents import *
+    from .fieldgenerator import *
+    from .util import *
+else:
+    # Import the submodules only when one of their names is used. That keeps
+    # ``import mongodbforms`` cheap and doesn't touch the settings.
+    from importlib import import_module
+
+    _exports = {
+        'documents': (
+            'construct_instance', 'save_instance', 'document_to_dict',
+            'fields_for_document', 'ModelFormOptions',
+            'DocumentFormMetaclass', 'BaseDocumentForm', 'DocumentForm',
+            'documentform_factory', 'EmbeddedDocumentForm',
+            'BaseDocumentFormSet', 'documentformset_factory',
+            'BaseInlineDocumentFormSet', 'inlineformset_factory',
+            'EmbeddedDocumentFormSet', 'embeddedformset_factory',
+        ),
+        'fieldgenerator': (
+            'MongoFormFieldGenerator', 'MongoDefaultFormFieldGenerator',
+            'Html5FormFieldGenerator',
+        ),
+        'util': (
+            'load_field_generator', 'get_default_field_generator',
+            'init_document_options', 'get_document_options',
+            'format_mongo_validation_errors', 'with_metaclass',
+        ),
+    }
+    _export_modules = dict(
+        (name, module) for module, names in _exports.items()
+        for name in names
+    )
+    # the modules that were star imported before, later ones shadow the
+    # names of earlier ones
+    _star_modules = ('django.forms.fields', '.documents', '.fieldgenerator',
+                     '.util')
+    # all names star imported from the modules, filled on first use
+    _star_names = {}
+
+    def _public_names(module):
+        names = getattr(module, '__all__', None)
+        if names is None:
+            names = [n for n in vars(module) if not n.startswith('_')]
+        return names
+
+    def _load_star_names():
+        if not _star_names:
+            for module_name in _star_modules:
+                module = import_module(module_name, __name__)
+                for name in _public_names(module):
+                    _star_names[name] = module_name
+        return _star_names
+
+    def __getattr__(name):
+        if name == '__all__':
+            names = set(_load_star_names())
+            # the submodules are package attributes once imported
+            names.update(
+                n for n, v in globals().items() if not n.startswith('_') and
+                getattr(v, '__name__', '').startswith(__name__ + '.'))
+            value = globals()['__all__'] = sorted(names)
+            return value
+        module_name = _export_modules.get(name)
+        if module_name is not None:
+            module_name = '.' + module_name
+        elif not name.startswith('_'):
+            # any other name the star imports exported, from the module that
+            # exported it last
+            module_name = _load_star_names().get(name)
+        if module_name is None:
+            raise AttributeError("module %r has no attribute %r" %
+                                 (__name__, name))
+        value = getattr(import_module(module_name, __name__), name)
+        globals()[name] = value
+        return value
+
+    def __dir__():
+        return sorted(set(globals()) | set(_export_modules))
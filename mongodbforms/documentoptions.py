@@ -1,10 +1,12 @@
 import sys
-from collections import MutableMapping
-from types import MethodType
+import threading
+from collections import MutableMapping, namedtuple
+from types import FunctionType, MethodType
 
 from django.db.models.fields import FieldDoesNotExist
 from django.utils.text import capfirst
-from django.utils.functional import LazyObject, new_method_proxy
+from django.utils.functional import (LazyObject, SimpleLazyObject,
+                                     new_method_proxy)
 try:
     # New in Django 1.7+
     from django.utils.text import camel_case_to_spaces
@@ -23,24 +25,124 @@ def patch_document(function, instance, bound=True):
     setattr(instance, function.__name__, method)
 
 
+def flatten_choices(choices):
+    """
+    Flattens grouped choices into a list of (value, label) pairs. mongoengine
+    also allows plain values as choices, they are their own label.
+    """
+    flat = []
+    if choices is not None:
+        for choice in choices:
+            if not isinstance(choice, (list, tuple)) or len(choice) != 2:
+                flat.append((choice, choice))
+                continue
+            choice, value = choice
+            if isinstance(value, (list, tuple)):
+                flat.extend(value)
+            else:
+                flat.append((choice, value))
+    return flat
+
+
+class FrozenDict(dict):
+    """A dict that can't be changed after it was created."""
+    def _immutable(self, *args, **kwargs):
+        raise TypeError('%s is immutable' % self.__class__.__name__)
+
+    __setitem__ = __delitem__ = _immutable
+    clear = pop = popitem = setdefault = update = __ior__ = _immutable
+
+    def __copy__(self):
+        return self
+
+    def __deepcopy__(self, memo):
+        return self
+
+    def __reduce__(self):
+        return (self.__class__, (dict(self), ))
+
+
+def lazy_flatchoices(choices):
+    """
+    Returns the flattened ``choices``. They are only flattened when they
+    are used for the first time.
+    """
+    if not choices:
+        return []
+    return SimpleLazyObject(lambda: flatten_choices(choices))
+
+
+# Built once per DocumentMetaWrapper.
+# by_name: maps a field name to (field, model, direct, m2m)
+# fields: all fields in the documents order
+# reference_fields: the ReferenceFields of the document
+# flatchoices: maps a field name to the flattened choices of the field, see
+#              lazy_flatchoices
+FieldIndex = namedtuple('FieldIndex', ['by_name', 'fields',
+                                       'reference_fields', 'flatchoices'])
+
+
 def create_verbose_name(name):
     name = camel_case_to_spaces(name)
     name = name.replace('_', ' ')
     return name
 
 
+_verbose_names = {}
+
+
+def _verbose_name(name):
+    verbose_name = _verbose_names.get(name)
+    if verbose_name is None:
+        verbose_name = _verbose_names[name] = capfirst(
+            create_verbose_name(name))
+    return verbose_name
+
+
+def is_document_meta(meta):
+    # check for the lazy wrapper first. isinstance(lazy, DocumentMetaWrapper)
+    # goes through the proxied __class__ and sets the lazy wrapper up.
+    return isinstance(meta, LazyDocumentMetaWrapper) or \
+        isinstance(meta, DocumentMetaWrapper)
+
+
+# The glue Django expects on fields that aren't relations, at least in the
+# admin. Only set on the fields of wrapped documents.
+_plain_field_attributes = (
+    ('many_to_many', None),
+    ('many_to_one', None),
+    ('one_to_many', None),
+    ('one_to_one', None),
+    ('related_model', None),
+    # FIXME: No longer used in Django 1.7?
+    ('rel', None),
+    ('is_relation', False),
+)
+
+
+def _setup_relation(field):
+    # FIXME: Probably broken in Django 1.7
+    field.rel = Relation(field=field)
+    field.is_relation = True
+
+
 class Relation(object):
     # just an empty dict to make it useable with Django
     # mongoengine has no notion of this
     limit_choices_to = {}
 
-    def __init__(self, to):
+    def __init__(self, to=None, field=None):
+        # with a field the document is looked up on first use, that
+        # may resolve a document name
         self._to = to
+        self._field = field
 
     @property
     def to(self):
-        if not isinstance(self._to._meta, (DocumentMetaWrapper, LazyDocumentMetaWrapper)):
-            self._to._meta = DocumentMetaWrapper(self._to)
+        if self._to is None and self._field is not None:
+            self._to = self._field.document_type
+        if not is_document_meta(self._to._meta):
+            self._to._meta = get_document_meta(self._to)
         return self._to
 
     @to.setter
@@ -49,21 +151,35 @@ class Relation(object):
 
 
 class PkWrapper(object):
+    """
+    Wraps a document's pk field and adds the attributes Django expects on
+    a pk field, like name and attname. Everything else is read from the
+    wrapped field. Only methods of the field's class are cached on the
+    wrapper, other attributes like required may be changed on the field.
+    """
+    __slots__ = ('obj', '__dict__')
+
     editable = False
     fake = False
 
     def __init__(self, wrapped):
-        self.obj = wrapped
+        object.__setattr__(self, 'obj', wrapped)
 
     def __getattr__(self, attr):
-        if attr in dir(self.obj):
-            return getattr(self.obj, attr)
-        raise AttributeError
+        # A missing slot means __init__ didn't run yet (copy, pickle),
+        # so don't recurse.
+        if attr == 'obj':
+            raise AttributeError(attr)
+        value = getattr(self.obj, attr)
+        if isinstance(getattr(type(self.obj), attr, None), FunctionType) \
+                and attr not in getattr(self.obj, '__dict__', ()):
+            self.__dict__[attr] = value
+        return value
 
     def __setattr__(self, attr, value):
         if attr != 'obj' and hasattr(self.obj, attr):
             setattr(self.obj, attr, value)
-        super(PkWrapper, self).__setattr__(attr, value)
+        object.__setattr__(self, attr, value)
 
 
 class LazyDocumentMetaWrapper(LazyObject):
@@ -76,7 +192,7 @@ class LazyDocumentMetaWrapper(LazyObject):
         super(LazyDocumentMetaWrapper, self).__init__()
 
     def _setup(self):
-        self._wrapped = DocumentMetaWrapper(self._document, self._meta)
+        self._wrapped = get_document_meta(self._document, self._meta)
 
     def __setattr__(self, name, value):
         if name in ["_document", "_meta", ]:
@@ -111,6 +227,7 @@ class DocumentMetaWrapper(MutableMapping):
     parents = {}
     many_to_many = []
     _field_cache = None
+    _field_index = None
     document = None
     _meta = None
     concrete_model = None
@@ -150,41 +267,24 @@ class DocumentMetaWrapper(MutableMapping):
     def _setup_document_fields(self):
         for f in self.document._fields.values():
             # Yay, more glue. Django expects fields to have a couple attributes
-            # at least in the admin, probably in more places.
+            # at least in the admin, probably in more places. Everything that
+            # needs another document is resolved on first use.
             if not hasattr(f, 'rel'):
-                # need a bit more for actual reference fields here
                 if isinstance(f, ReferenceField):
-                    # FIXME: Probably broken in Django 1.7
-                    f.rel = Relation(f.document_type)
-                    f.is_relation = True
-                elif isinstance(f, ListField) and isinstance(f.field, ReferenceField):
-                    # FIXME: Probably broken in Django 1.7
-                    f.field.rel = Relation(f.field.document_type)
-                    f.field.is_relation = True
+                    _setup_relation(f)
+                elif isinstance(f, ListField) and \
+                        isinstance(f.field, ReferenceField):
+                    _setup_relation(f.field)
                 else:
-                    f.many_to_many = None
-                    f.many_to_one = None
-                    f.one_to_many = None
-                    f.one_to_one = None
-                    f.related_model = None
-
-                    # FIXME: No longer used in Django 1.7?
-                    f.rel = None
-                    f.is_relation = False
-            if not hasattr(f, 'verbose_name') or f.verbose_name is None:
-                f.verbose_name = capfirst(create_verbose_name(f.name))
+                    for name, value in _plain_field_attributes:
+                        setattr(f, name, value)
+            if getattr(f, 'verbose_name', None) is None:
+                f.verbose_name = _verbose_name(f.name)
             if not hasattr(f, 'flatchoices'):
-                flat = []
-                if f.choices is not None:
-                    for choice, value in f.choices:
-                        if isinstance(value, (list, tuple)):
-                            flat.extend(value)
-                        else:
-                            flat.append((choice, value))
-                f.flatchoices = flat
-            if isinstance(f, ReferenceField) and not \
-                    isinstance(f.document_type._meta, (DocumentMetaWrapper, LazyDocumentMetaWrapper)) and \
-                    self.document != f.document_type:
+                f.flatchoices = lazy_flatchoices(f.choices)
+            if isinstance(f, ReferenceField) and \
+                    self.document != f.document_type and \
+                    not is_document_meta(f.document_type._meta):
                 f.document_type._meta = LazyDocumentMetaWrapper(f.document_type)
             if not hasattr(f, 'auto_created'):
                 f.auto_created = False
@@ -203,9 +303,10 @@ class DocumentMetaWrapper(MutableMapping):
             pk_field = None
         self.pk = PkWrapper(pk_field)
 
-        def _get_pk_val(obj):
-            return obj.pk
-        patch_document(_get_pk_val, self.document, False)  # document is a class...
+        if not hasattr(self.document, '_get_pk_val'):
+            def _get_pk_val(obj):
+                return obj.pk
+            patch_document(_get_pk_val, self.document, False)  # document is a class...
 
         if pk_field is not None:
             self.pk.name = self.pk_name
@@ -260,6 +361,41 @@ class DocumentMetaWrapper(MutableMapping):
     def get_ordered_objects(self):
         return []
 
+    @property
+    def field_index(self):
+        """
+        The precomputed FieldIndex of the document. Built on first access.
+        """
+        index = self._field_index
+        if index is None:
+            index = self._field_index = self._build_field_index()
+        return index
+
+    def _build_field_index(self):
+        document_fields = self.document._fields
+        names = getattr(self.document, '_fields_ordered', None)
+        if not names:
+            names = document_fields.keys()
+        by_name = {}
+        fields = []
+        reference_fields = []
+        flatchoices = {}
+        for name in names:
+            field = document_fields[name]
+            fields.append(field)
+            if isinstance(field, ReferenceField):
+                by_name[name] = (field, field.document_type, False, False)
+                reference_fields.append(field)
+            else:
+                by_name[name] = (field, None, True, False)
+            # the field's lazy list, so the choices are flattened only once
+            choices = getattr(field, 'flatchoices', None)
+            if choices is None:
+                choices = lazy_flatchoices(field.choices)
+            flatchoices[name] = choices
+        return FieldIndex(FrozenDict(by_name), tuple(fields),
+                          tuple(reference_fields), FrozenDict(flatchoices))
+
     def get_field_by_name(self, name):
         """
         Returns the (field_object, model, direct, m2m), where field_object is
@@ -270,15 +406,11 @@ class DocumentMetaWrapper(MutableMapping):
         for this field (since the field doesn't have an instance associated
         with it).
         """
-        if name in self.document._fields:
-            field = self.document._fields[name]
-            if isinstance(field, ReferenceField):
-                return (field, field.document_type, False, False)
-            else:
-                return (field, None, True, False)
-        else:
+        field = self.field_index.by_name.get(name)
+        if field is None:
             raise FieldDoesNotExist('%s has no field named %r' %
                                     (self.object_name, name))
+        return field
 
     def get_field(self, name, many_to_many=True):
         """
@@ -287,7 +419,13 @@ class DocumentMetaWrapper(MutableMapping):
         return self.get_field_by_name(name)[0]
 
     def get_fields(self, include_hidden=False):
-        return self.document._fields.values()
+        return self.field_index.fields
+
+    def get_reference_fields(self):
+        return self.field_index.reference_fields
+
+    def get_flatchoices(self, name):
+        return self.field_index.flatchoices.get(name, ())
 
     @property
     def swapped(self):
@@ -324,10 +462,10 @@ class DocumentMetaWrapper(MutableMapping):
         if name in self._deprecated_attrs:
             return getattr(self, self._deprecated_attrs.get(name))
 
-        try:
-            return self._meta[name]
-        except KeyError:
-            raise AttributeError
+        meta = self._meta
+        if meta is not None and name in meta:
+            return meta[name]
+        raise AttributeError(name)
 
     def __setattr__(self, name, value):
         if not hasattr(self, name):
@@ -373,3 +511,65 @@ class DocumentMetaWrapper(MutableMapping):
 
     def iteritems(self):
         return iter(self._meta.items())
+
+
+# Process wide registry of DocumentMetaWrappers. Building a wrapper patches
+# the document class and all of its fields, so it should happen only once.
+_meta_registry = {}
+_meta_registry_lock = threading.RLock()
+_meta_registry_stats = {'built': 0}
+
+
+def get_document_meta(document, meta=None):
+    """
+    Returns the DocumentMetaWrapper for ``document``. The wrapper is built
+    on first use and shared by all callers afterwards.
+
+    ``meta`` is the original _meta dict of the document. It is read from the
+    document if not given.
+    """
+    if not isinstance(document, type):
+        document = document.__class__
+    wrapper = _meta_registry.get(document)
+    if wrapper is not None:
+        return wrapper
+
+    with _meta_registry_lock:
+        wrapper = _meta_registry.get(document)
+        if wrapper is not None:
+            return wrapper
+        if meta is None:
+            meta = getattr(document, '_meta', {})
+        # check the type and not isinstance. isinstance on a lazy wrapper
+        # would set it up and end up right here again.
+        if type(meta) is LazyDocumentMetaWrapper:
+            meta = meta._meta
+        if type(meta) is DocumentMetaWrapper and meta.document is document:
+            wrapper = meta
+        else:
+            if type(meta) is DocumentMetaWrapper:
+                # inherited from a parent document
+                meta = meta._meta
+            wrapper = DocumentMetaWrapper(document, meta)
+            _meta_registry_stats['built'] += 1
+        _meta_registry[document] = wrapper
+    return wrapper
+
+
+def document_meta_stats():
+    """
+    Returns a dict with the number of wrappers ever ``built`` and the number
+    of ``documents`` currently in the registry.
+    """
+    with _meta_registry_lock:
+        return {
+            'built': _meta_registry_stats['built'],
+            'documents': len(_meta_registry),
+        }
+
+
+def clear_document_meta_registry():
+    """Empties the registry. Mostly useful for tests."""
+    with _meta_registry_lock:
+        _meta_registry.clear()
+        _meta_registry_stats['built'] = 0
@@ -1,7 +1,7 @@
 import os
+import re
 import itertools
 from collections import Callable, OrderedDict
-from functools import reduce
 
 from django.forms.forms import (BaseForm, DeclarativeFieldsMetaclass,
                                 NON_FIELD_ERRORS, pretty_name)
@@ -26,27 +26,40 @@ try:
     from mongoengine.base import ValidationError
 except ImportError:
     from mongoengine.errors import ValidationError
-from mongoengine.queryset import OperationError, Q
+from mongoengine.queryset import OperationError
+try:
+    from mongoengine.errors import NotUniqueError
+except ImportError:
+    # mongoengine < 0.7 raises an OperationError for duplicate keys
+    NotUniqueError = OperationError
+from pymongo.errors import DuplicateKeyError
 from mongoengine.queryset.base import BaseQuerySet
 from mongoengine.connection import get_db, DEFAULT_CONNECTION_NAME
 from mongoengine.base import NON_FIELD_ERRORS as MONGO_NON_FIELD_ERRORS
 
-from gridfs import GridFS
-
-from mongodbforms.documentoptions import DocumentMetaWrapper
-from mongodbforms.util import with_metaclass, load_field_generator
-
-_fieldgenerator = load_field_generator()
+from mongodbforms.documentoptions import DocumentMetaWrapper, get_document_meta
+from mongodbforms.fieldgenerator import get_field_generator
+from mongodbforms.fields import (GenericReferenceField as
+                                 GenericReferenceFormField,
+                                 resolve_generic_references)
+from mongodbforms.instrumentation import instrumented, span, query
+from mongodbforms.util import (with_metaclass, get_default_field_generator,
+                               LRUCache, make_cache_key)
 
 
 def _get_unique_filename(name, db_alias=DEFAULT_CONNECTION_NAME,
                          collection_name='fs'):
+    # only needed if a form actually handles files
+    from gridfs import GridFS
+
     fs = GridFS(get_db(db_alias), collection_name)
     file_root, file_ext = os.path.splitext(get_valid_filename(name))
     count = itertools.count(1)
+    query('gridfs.exists')
     while fs.exists(filename=name):
         # file_ext includes the dot.
         name = os.path.join("%s_%s%s" % (file_root, next(count), file_ext))
+        query('gridfs.exists')
     return name
 
 
@@ -65,19 +78,24 @@ def _save_iterator_file(field, instance, uploaded_file, file_data=None):
     if file_data.key is None:
         file_data.key = field.name
 
-    if file_data.grid_id:
-        file_data.delete()
+    with span('gridfs.save_file'):
+        if file_data.grid_id:
+            query('gridfs.delete')
+            file_data.delete()
 
-    uploaded_file.seek(0)
-    filename = _get_unique_filename(uploaded_file.name, field.field.db_alias,
-                                    field.field.collection_name)
-    file_data.put(uploaded_file, content_type=uploaded_file.content_type,
-                  filename=filename)
-    file_data.close()
+        uploaded_file.seek(0)
+        filename = _get_unique_filename(uploaded_file.name,
+                                        field.field.db_alias,
+                                        field.field.collection_name)
+        query('gridfs.put')
+        file_data.put(uploaded_file, content_type=uploaded_file.content_type,
+                      filename=filename)
+        file_data.close()
 
     return file_data
 
 
+@instrumented('construct_instance')
 def construct_instance(form, instance, fields=None, exclude=None):
     """
     Constructs and returns a document instance from the bound ``form``'s
@@ -109,6 +127,13 @@ def construct_instance(form, instance, fields=None, exclude=None):
         else:
             setattr(instance, f.name, cleaned_data.get(f.name))
 
+    nested_fields = getattr(getattr(form, '_meta', None), 'nested_fields',
+                            None)
+    for name in nested_fields or ():
+        f = instance._fields.get(name)
+        if isinstance(f, EmbeddedDocumentField):
+            _construct_embedded(instance, f, cleaned_data, name)
+
     for f in file_field_list:
         if isinstance(f, MapField):
             map_field = getattr(instance, f.name)
@@ -145,23 +170,84 @@ def construct_instance(form, instance, fields=None, exclude=None):
 
             try:
                 upload.file.seek(0)
-                # delete first to get the names right
-                if field.grid_id:
-                    field.delete()
-                filename = _get_unique_filename(upload.name, f.db_alias,
-                                                f.collection_name)
-                field.put(upload, content_type=upload.content_type,
-                          filename=filename)
+                with span('gridfs.save_file'):
+                    # delete first to get the names right
+                    if field.grid_id:
+                        query('gridfs.delete')
+                        field.delete()
+                    filename = _get_unique_filename(upload.name, f.db_alias,
+                                                    f.collection_name)
+                    query('gridfs.put')
+                    field.put(upload, content_type=upload.content_type,
+                              filename=filename)
                 setattr(instance, f.name, field)
             except AttributeError:
                 # file was already uploaded and not changed during edit.
                 # upload is already the gridfsproxy object we need.
+                query('gridfs.get')
                 upload.get()
                 setattr(instance, f.name, upload)
 
     return instance
 
 
+def _embedded_paths(field, prefix):
+    """
+    Yields the ``(path, field)`` pairs of the fields of the embedded document
+    of ``field``, recursing into nested embedded documents. Paths are the
+    form field names, e.g. ``address__city``.
+    """
+    document = field.document_type
+    for name in document._fields_ordered:
+        sub_field = document._fields[name]
+        path = '%s__%s' % (prefix, name)
+        if isinstance(sub_field, EmbeddedDocumentField):
+            for item in _embedded_paths(sub_field, path):
+                yield item
+        else:
+            yield path, sub_field
+
+
+def _construct_embedded(instance, field, cleaned_data, prefix):
+    """
+    Writes the cleaned values of an inline embedded document into the
+    existing embedded document of ``instance``. Only changed values are
+    marked as changed, so saving the instance sends a ``$set`` for the
+    changed paths (``address.city``) instead of the whole embedded document.
+    """
+    embedded = getattr(instance, field.name, None)
+    if embedded is None:
+        values = [cleaned_data.get(path)
+                  for path, f in _embedded_paths(field, prefix)]
+        if not field.required and \
+                all(value in EMPTY_VALUES for value in values):
+            return
+        embedded = field.document_type()
+        setattr(instance, field.name, embedded)
+    for name in embedded._fields_ordered:
+        sub_field = embedded._fields[name]
+        path = '%s__%s' % (prefix, name)
+        if isinstance(sub_field, EmbeddedDocumentField):
+            _construct_embedded(embedded, sub_field, cleaned_data, path)
+        elif path in cleaned_data:
+            setattr(embedded, name, cleaned_data[path])
+
+
+def _embedded_error_dict(prefix, error):
+    """
+    Maps a mongoengine ``ValidationError`` of an embedded document to the
+    form fields of the inline embedded document.
+    """
+    errors = getattr(error, 'errors', None)
+    if not errors:
+        return {prefix: [getattr(error, 'message', error)]}
+    result = {}
+    for name, sub_error in errors.items():
+        result.update(_embedded_error_dict('%s__%s' % (prefix, name),
+                                           sub_error))
+    return result
+
+
 def save_instance(form, instance, fields=None, fail_message='saved',
                   commit=True, exclude=None, construct=True):
     """
@@ -191,11 +277,65 @@ def save_instance(form, instance, fields=None, fail_message='saved',
         #    instance.save()
         #    instance._data = data
         # else:
+        query('save')
         instance.save()
     return instance
 
 
-def document_to_dict(instance, fields=None, exclude=None):
+_duplicate_index_re = re.compile(r'index: (\S+) dup key')
+
+
+def _duplicate_key_fields(document, error):
+    """
+    Returns the names of the fields in the unique index that ``error``
+    (a ``NotUniqueError`` or ``DuplicateKeyError``) was raised for, or an
+    empty list if the index can't be found.
+    """
+    # mongoengine raises NotUniqueError from the DuplicateKeyError
+    cause = error
+    while cause is not None and not isinstance(cause, DuplicateKeyError):
+        cause = getattr(cause, '__cause__', None) or \
+            getattr(cause, '__context__', None)
+    details = getattr(cause, 'details', None) or {}
+    # MongoDB >= 4.2 reports the key pattern of the index
+    db_fields = list(details.get('keyPattern', None) or [])
+    if not db_fields:
+        match = _duplicate_index_re.search(str(error))
+        if match is None:
+            return []
+        for spec in document._meta.get('index_specs', None) or []:
+            name = spec.get('name') or '_'.join(
+                '%s_%s' % field for field in spec['fields'])
+            if name == match.group(1):
+                db_fields = [field for field, direction in spec['fields']]
+                break
+    reverse_map = getattr(document, '_reverse_db_field_map', {})
+    return [reverse_map.get(name, name) for name in db_fields]
+
+
+def _is_reference_field(field):
+    return isinstance(field, ReferenceField) or \
+        (isinstance(field, ListField) and
+         isinstance(field.field, ReferenceField))
+
+
+def _reference_list_filter(name, references):
+    """
+    Returns the filter for lists containing the same ``references`` in any
+    order: ``$all`` of the references plus ``$size``. An index on the list
+    field can be used for the ``$all`` part, so the query doesn't grow more
+    expensive with longer lists.
+    """
+    references = list(references or [])
+    filter_kwargs = {'%s__size' % name: len(references)}
+    # $all of an empty list matches nothing
+    if references:
+        filter_kwargs['%s__all' % name] = references
+    return filter_kwargs
+
+
+def document_to_dict(instance, fields=None, exclude=None, raw_initial=False,
+                     nested_fields=None):
     """
     Returns a dict containing the data in ``instance`` suitable for passing as
     a Form's ``initial`` keyword argument.
@@ -206,6 +346,12 @@ def document_to_dict(instance, fields=None, exclude=None):
     ``exclude`` is an optional list of field names. If provided, the named
     fields will be excluded from the returned dict, even if they are listed in
     the ``fields`` argument.
+
+    If ``raw_initial`` is True, references are returned as stored (ObjectIds
+    or DBRefs) instead of being dereferenced.
+
+    The fields of the embedded documents in ``nested_fields`` are added
+    with their paths as keys, e.g. ``address__city``.
     """
     data = {}
     for f in instance._fields.values():
@@ -213,13 +359,30 @@ def document_to_dict(instance, fields=None, exclude=None):
             continue
         if exclude and f.name in exclude:
             continue
+        if nested_fields and f.name in nested_fields and \
+                isinstance(f, EmbeddedDocumentField):
+            for path, sub_field in _embedded_paths(f, f.name):
+                value = instance
+                for name in path.split('__'):
+                    value = getattr(value, name, None)
+                    if value is None:
+                        break
+                data[path] = value
+            continue
+        if raw_initial and _is_reference_field(f):
+            value = instance._data.get(f.name)
+            if isinstance(value, list):
+                value = list(value)
+            data[f.name] = value
+            continue
         data[f.name] = getattr(instance, f.name, '')
     return data
 
 
+@instrumented('fields_for_document')
 def fields_for_document(document, fields=None, exclude=None, widgets=None,
                         formfield_callback=None,
-                        field_generator=_fieldgenerator):
+                        field_generator=None, nested_fields=None):
     """
     Returns a ``SortedDict`` containing form fields for the given model.
 
@@ -229,10 +392,19 @@ def fields_for_document(document, fields=None, exclude=None, widgets=None,
     ``exclude`` is an optional list of field names. If provided, the named
     fields will be excluded from the returned fields, even if they are listed
     in the ``fields`` argument.
+
+    ``field_generator`` defaults to the generator set with
+    ``MONGODBFORMS_FIELDGENERATOR``.
+
+    ``nested_fields`` is an optional list of names of EmbeddedDocumentFields.
+    The fields of their documents are included inline, named by their path
+    (``address__city``).
     """
     field_list = []
+    if field_generator is None:
+        field_generator = get_default_field_generator()
     if isinstance(field_generator, type):
-        field_generator = field_generator()
+        field_generator = get_field_generator(field_generator)
 
     if formfield_callback and not isinstance(formfield_callback, Callable):
         raise TypeError('formfield_callback must be a function or callable')
@@ -250,6 +422,22 @@ def fields_for_document(document, fields=None, exclude=None, widgets=None,
         else:
             kwargs = {}
 
+        if nested_fields and f.name in nested_fields and \
+                isinstance(f, EmbeddedDocumentField):
+            for path, sub_field in _embedded_paths(f, f.name):
+                kwargs = {}
+                if widgets and path in widgets:
+                    kwargs['widget'] = widgets[path]
+                if formfield_callback:
+                    formfield = formfield_callback(sub_field, **kwargs)
+                else:
+                    formfield = field_generator.generate(sub_field, **kwargs)
+                if formfield:
+                    # an optional embedded document may be left empty
+                    formfield.required = formfield.required and f.required
+                    field_list.append((path, formfield))
+            continue
+
         if formfield_callback:
             formfield = formfield_callback(f, **kwargs)
         else:
@@ -260,10 +448,18 @@ def fields_for_document(document, fields=None, exclude=None, widgets=None,
 
     field_dict = OrderedDict(field_list)
     if fields:
-        field_dict = OrderedDict(
-            [(f, field_dict.get(f)) for f in fields
-                if ((not exclude) or (exclude and f not in exclude))]
-        )
+        ordered = []
+        for f in fields:
+            if exclude and f in exclude:
+                continue
+            if nested_fields and f in nested_fields:
+                prefix = '%s__' % f
+                ordered.extend((name, field) for name, field
+                               in field_dict.items()
+                               if name.startswith(prefix))
+            else:
+                ordered.append((f, field_dict.get(f)))
+        field_dict = OrderedDict(ordered)
 
     return field_dict
 
@@ -281,13 +477,20 @@ class ModelFormOptions(object):
         # set up the document meta wrapper if document meta is a dict
         if self.document is not None and \
                 not isinstance(meta, DocumentMetaWrapper):
-            self.document._meta = DocumentMetaWrapper(self.document)
+            self.document._meta = get_document_meta(self.document)
         self.fields = getattr(options, 'fields', None)
         self.exclude = getattr(options, 'exclude', None)
         self.widgets = getattr(options, 'widgets', None)
         self.embedded_field = getattr(options, 'embedded_field_name', None)
+        self.raw_initial = getattr(options, 'raw_initial', False)
+        self.nested_fields = getattr(options, 'nested_fields', None)
+        self.guard_changes = getattr(options, 'guard_changes', False)
+        self.trust_unique_indexes = getattr(options, 'trust_unique_indexes',
+                                            False)
         self.formfield_generator = getattr(options, 'formfield_generator',
-                                           _fieldgenerator)
+                                           None)
+        if self.formfield_generator is None:
+            self.formfield_generator = get_default_field_generator()
 
         self._dont_save = []
 
@@ -319,15 +522,14 @@ class DocumentFormMetaclass(DeclarativeFieldsMetaclass):
             getattr(new_class, 'Meta', None)
         )
         if opts.document:
-            formfield_generator = getattr(opts,
-                                          'formfield_generator',
-                                          _fieldgenerator)
+            formfield_generator = opts.formfield_generator
 
             # If a model is defined, extract form fields from it.
             fields = fields_for_document(opts.document, opts.fields,
                                          opts.exclude, opts.widgets,
                                          formfield_callback,
-                                         formfield_generator)
+                                         formfield_generator,
+                                         opts.nested_fields)
             # make sure opts.fields doesn't specify an invalid field
             none_document_fields = [k for k, v in fields.items() if not v]
             missing_fields = (set(none_document_fields) -
@@ -347,7 +549,48 @@ class DocumentFormMetaclass(DeclarativeFieldsMetaclass):
         return new_class
 
 
+def _generic_reference_values(form):
+    """
+    Yields ``(field, values)`` for the submitted values of the generic
+    reference fields of a bound form. For list fields ``field`` is the
+    contained field that cleans the values.
+    """
+    for name, field in form.fields.items():
+        if not isinstance(field, GenericReferenceFormField):
+            field = getattr(field, 'contained_field', None)
+            if not isinstance(field, GenericReferenceFormField):
+                continue
+        value = form.fields[name].widget.value_from_datadict(
+            form.data, form.files, form.add_prefix(name))
+        if not isinstance(value, (list, tuple)):
+            value = [value]
+        yield field, value
+
+
+def _resolve_generic_references(forms):
+    """
+    Loads the submitted generic references of all fields of ``forms`` at
+    once, with one query per document class instead of one per value.
+    """
+    fields = []
+    keys = []
+    for form in forms:
+        form._generic_references_resolved = True
+        for field, values in _generic_reference_values(form):
+            fields.append(field)
+            for value in values:
+                key = field.to_key(value) if value else None
+                if key is not None:
+                    keys.append(key)
+    if not fields:
+        return
+    resolved = resolve_generic_references(keys)
+    for field in fields:
+        field.resolved = resolved
+
+
 class BaseDocumentForm(BaseForm):
+    _generic_references_resolved = False
 
     def __init__(self, data=None, files=None, auto_id='id_%s', prefix=None,
                  initial=None, error_class=ErrorList, label_suffix=':',
@@ -363,7 +606,8 @@ class BaseDocumentForm(BaseForm):
             object_data = {}
         else:
             self.instance = instance
-            object_data = document_to_dict(instance, opts.fields, opts.exclude)
+            object_data = document_to_dict(instance, opts.fields, opts.exclude,
+                                           opts.raw_initial, opts.nested_fields)
 
         # if initial was provided, it should override the values from instance
         if initial is not None:
@@ -396,9 +640,13 @@ class BaseDocumentForm(BaseForm):
         details: #12507, #12521, #12553
         """
         exclude = []
+        nested_fields = self._meta.nested_fields or ()
         # Build up a list of fields that should be excluded from model field
         # validation and unique checks.
         for f in self.instance._fields.values():
+            # Inline embedded documents are validated in _post_clean
+            if f.name in nested_fields:
+                continue
             # Exclude fields that aren't on the form. The developer may be
             # adding these values to the model after form validation.
             if f.name not in self.fields:
@@ -429,10 +677,17 @@ class BaseDocumentForm(BaseForm):
                     exclude.append(f.name)
         return exclude
 
+    def full_clean(self):
+        # formsets resolve the references of all their forms in advance
+        if self.is_bound and not self._generic_references_resolved:
+            _resolve_generic_references([self])
+        super(BaseDocumentForm, self).full_clean()
+
     def clean(self):
         self._validate_unique = True
         return self.cleaned_data
 
+    @instrumented('form.post_clean')
     def _post_clean(self):
         opts = self._meta
 
@@ -442,6 +697,20 @@ class BaseDocumentForm(BaseForm):
         changed_fields = getattr(self.instance, '_changed_fields', [])
 
         exclude = self._get_validation_exclusions()
+        nested_fields = opts.nested_fields or ()
+        for name in nested_fields:
+            value = getattr(self.instance, name, None)
+            if value is None:
+                continue
+            try:
+                self.instance._fields[name].validate(value)
+            except ValidationError as e:
+                for path, messages in _embedded_error_dict(name, e).items():
+                    if path not in self.fields:
+                        path = NON_FIELD_ERRORS
+                    self._update_errors({path: messages})
+        # validated above
+        exclude = exclude + list(nested_fields)
         try:
             for f in self.instance._fields.values():
                 value = getattr(self.instance, f.name)
@@ -482,53 +751,72 @@ class BaseDocumentForm(BaseForm):
         if self._validate_unique:
             self.validate_unique()
 
+    @instrumented('form.validate_unique')
     def validate_unique(self):
         """
         Validates unique constrains on the document.
         unique_with is supported now.
+
+        Does nothing if the form's Meta sets ``trust_unique_indexes``. The
+        unique indexes are checked by ``save`` then.
         """
         errors = []
+        if self._meta.trust_unique_indexes:
+            return errors
         exclude = self._get_validation_exclusions()
         for f in self.instance._fields.values():
             if f.unique and f.name not in exclude:
                 filter_kwargs = {
                     f.name: getattr(self.instance, f.name),
-                    'q_obj': None,
                 }
                 if f.unique_with:
                     for u_with in f.unique_with:
                         u_with_field = self.instance._fields[u_with]
-                        u_with_attr = getattr(self.instance, u_with)
-                        # handling ListField(ReferenceField()) sucks big time
-                        # What we need to do is construct a Q object that
-                        # queries for the pk of every list entry and only
-                        # accepts lists with the same length as our list
                         if isinstance(u_with_field, ListField) and \
                                 isinstance(u_with_field.field, ReferenceField):
-                            q_list = [Q(**{u_with: k.pk}) for k in u_with_attr]
-                            q = reduce(lambda x, y: x & y, q_list)
-                            size_key = '%s__size' % u_with
-                            q = q & Q(**{size_key: len(u_with_attr)})
-                            filter_kwargs['q_obj'] = q & filter_kwargs['q_obj']
+                            # the stored references, no need to dereference
+                            # them for the query
+                            filter_kwargs.update(_reference_list_filter(
+                                u_with, self.instance._data.get(u_with)))
                         else:
-                            filter_kwargs[u_with] = u_with_attr
+                            filter_kwargs[u_with] = getattr(self.instance,
+                                                            u_with)
                 qs = self.instance.__class__.objects.clone()
                 qs = qs.no_dereference().filter(**filter_kwargs)
                 # Exclude the current object from the query if we are editing
                 # an instance (as opposed to creating a new one)
                 if self.instance.pk is not None:
                     qs = qs.filter(pk__ne=self.instance.pk)
+                query('count')
                 if qs.count() > 0:
-                    message = _("%s with this %s already exists.") % (
-                        str(capfirst(self.instance._meta.verbose_name)),
-                        str(pretty_name(f.name))
-                    )
-                    err_dict = {f.name: [message]}
+                    err_dict = {f.name: [self._unique_message(f.name)]}
                     self._update_errors(err_dict)
                     errors.append(err_dict)
 
         return errors
 
+    def _unique_message(self, name):
+        return _("%s with this %s already exists.") % (
+            str(capfirst(self.instance._meta.verbose_name)),
+            str(pretty_name(name))
+        )
+
+    def _update_unique_errors(self, error):
+        """
+        Adds the form error for the unique index violation ``error`` to the
+        first field of the index. Returns False if the index is unknown.
+        """
+        names = _duplicate_key_fields(self.instance.__class__, error)
+        if not names:
+            return False
+        name = next((n for n in names if n in self.fields), None)
+        if name is None:
+            self._update_errors({NON_FIELD_ERRORS: [
+                self._unique_message(', '.join(names))]})
+        else:
+            self._update_errors({name: [self._unique_message(name)]})
+        return True
+
     def save(self, commit=True):
         """
         Saves this ``form``'s cleaned_data into model instance
@@ -536,6 +824,9 @@ class BaseDocumentForm(BaseForm):
 
         If commit=True, then the changes to ``instance`` will be saved to the
         database. Returns ``instance``.
+
+        If the form's Meta sets ``trust_unique_indexes``, a unique index
+        violation is added to the form errors and a ``ValueError`` raised.
         """
         try:
             if self.instance.pk is None:
@@ -544,8 +835,18 @@ class BaseDocumentForm(BaseForm):
                 fail_message = 'changed'
         except (KeyError, AttributeError):
             fail_message = 'embedded document saved'
-        obj = save_instance(self, self.instance, self._meta.fields,
-                            fail_message, commit, construct=False)
+        with span('form.save', document=self._meta.document):
+            try:
+                obj = save_instance(self, self.instance, self._meta.fields,
+                                    fail_message, commit, construct=False)
+            except (NotUniqueError, DuplicateKeyError) as e:
+                if not self._meta.trust_unique_indexes or \
+                        not self._update_unique_errors(e):
+                    raise
+                raise ValueError("The %s could not be %s because the data "
+                                 "didn't validate." %
+                                 (self.instance.__class__.__name__,
+                                  fail_message))
 
         return obj
     save.alters_data = True
@@ -555,14 +856,43 @@ class DocumentForm(with_metaclass(DocumentFormMetaclass, BaseDocumentForm)):
     pass
 
 
+_form_classes = LRUCache(maxsize=256)
+_formset_classes = LRUCache(maxsize=256)
+
+
 def documentform_factory(document, form=DocumentForm, fields=None,
                          exclude=None, formfield_callback=None):
+    """
+    Returns a DocumentForm class for ``document``.
+
+    Form classes are cached, calling the factory again with the same
+    arguments returns the same class. Don't change the returned class,
+    subclass it instead.
+    """
+    return _documentform_factory(document, form, fields, exclude,
+                                 formfield_callback)
+
+
+def _documentform_factory(document, form=DocumentForm, fields=None,
+                          exclude=None, formfield_callback=None,
+                          embedded_field=None):
+    key = None
+    if isinstance(document, type):
+        key = make_cache_key(document, form, fields, exclude,
+                             formfield_callback, embedded_field)
+    if key is not None:
+        form_class = _form_classes.get(key)
+        if form_class is not None:
+            return form_class
+
     # Build up a list of attributes that the Meta object will have.
     attrs = {'document': document, 'model': document}
     if fields is not None:
         attrs['fields'] = fields
     if exclude is not None:
         attrs['exclude'] = exclude
+    if embedded_field is not None:
+        attrs['embedded_field_name'] = embedded_field
 
     # If parent form class already has an inner Meta, the Meta we're
     # creating needs to inherit from the parent's inner meta.
@@ -571,12 +901,12 @@ def documentform_factory(document, form=DocumentForm, fields=None,
         parent = (form.Meta, object)
     Meta = type('Meta', parent, attrs)
 
-    # Give this new form class a reasonable name.
+    # Give this new form class a reasonable name. Don't instantiate the
+    # document for this, that may be expensive or have side effects.
     if isinstance(document, type):
-        doc_inst = document()
+        class_name = document.__name__ + 'Form'
     else:
-        doc_inst = document
-    class_name = doc_inst.__class__.__name__ + 'Form'
+        class_name = document.__class__.__name__ + 'Form'
 
     # Class attributes for the new form class.
     form_class_attrs = {
@@ -584,7 +914,10 @@ def documentform_factory(document, form=DocumentForm, fields=None,
         'formfield_callback': formfield_callback
     }
 
-    return DocumentFormMetaclass(class_name, (form,), form_class_attrs)
+    form_class = DocumentFormMetaclass(class_name, (form,), form_class_attrs)
+    if key is not None:
+        _form_classes.set(key, form_class)
+    return form_class
 
 
 class EmbeddedDocumentForm(with_metaclass(DocumentFormMetaclass,
@@ -618,6 +951,11 @@ class EmbeddedDocumentForm(with_metaclass(DocumentFormMetaclass,
                     None
                 )
 
+        # the stored values of the changed fields are compared when saving
+        self._initial_son = None
+        if self._meta.guard_changes and instance is not None:
+            self._initial_son = instance.to_mongo()
+
         super(EmbeddedDocumentForm, self).__init__(data=data, files=files,
                                                    instance=instance, *args,
                                                    **kwargs)
@@ -638,6 +976,7 @@ class EmbeddedDocumentForm(with_metaclass(DocumentFormMetaclass,
             field = self.parent_document._fields.get(self._meta.embedded_field)
             if isinstance(field, ListField) and self.position is None:
                 # no position given, simply appending to ListField
+                query('update')
                 try:
                     self.parent_document.update(**{
                         "push__" + self._meta.embedded_field: self.instance
@@ -645,8 +984,13 @@ class EmbeddedDocumentForm(with_metaclass(DocumentFormMetaclass,
                 except:
                     raise OperationError("The %s could not be appended." %
                                          self.instance.__class__.__name__)
+            elif self._is_stored_instance(field):
+                # only the changed fields of an embedded document that was
+                # loaded from the parent
+                self._update_changes(field)
             elif isinstance(field, ListField) and self.position is not None:
                 # updating ListField at given position
+                query('update')
                 try:
                     self.parent_document.update(**{
                         "__".join(("set", self._meta.embedded_field,
@@ -661,9 +1005,77 @@ class EmbeddedDocumentForm(with_metaclass(DocumentFormMetaclass,
                 # not a listfield on parent, treat as an embedded field
                 setattr(self.parent_document, self._meta.embedded_field,
                         self.instance)
+                query('save')
                 self.parent_document.save()
         return self.instance
 
+    def _is_stored_instance(self, field):
+        """
+        True if the instance is the embedded document of the saved parent
+        document, so its changes can be saved alone.
+        """
+        if self.parent_document.pk is None:
+            return False
+        value = getattr(self.parent_document, self._meta.embedded_field)
+        if isinstance(field, ListField):
+            if self.position is None or value is None or \
+                    self.position >= len(value):
+                return False
+            value = value[self.position]
+        return value is self.instance
+
+    def _update_changes(self, field):
+        """
+        Sends ``$set``/``$unset`` for the changed fields of the embedded
+        document only, e.g. ``{'$set': {'messages.3.subject': ...}}``. If
+        the form's Meta sets ``guard_changes``, the update only matches if
+        the changed fields still have their initial values.
+        """
+        # a raw update, so the stored name of the field
+        path = field.db_field
+        if isinstance(field, ListField):
+            path = '%s.%s' % (path, self.position)
+        sets, unsets = self.instance._delta()
+        if not sets and not unsets:
+            return
+        update = {}
+        if sets:
+            update['$set'] = dict(('%s.%s' % (path, k), v)
+                                  for k, v in sets.items())
+        if unsets:
+            update['$unset'] = dict(('%s.%s' % (path, k), 1)
+                                    for k in unsets)
+        guard = {}
+        if self._initial_son is not None:
+            for key in list(sets) + list(unsets):
+                guard['%s.%s' % (path, key)] = _lookup_path(
+                    self._initial_son, key)
+
+        qs = self.parent_document.__class__.objects(
+            pk=self.parent_document.pk, __raw__=guard)
+        query('update')
+        if not qs.update_one(__raw__=update):
+            raise OperationError("The %s could not be updated, it was "
+                                 "changed or removed in the meantime." %
+                                 self.instance.__class__.__name__)
+        self.instance._clear_changed_fields()
+
+
+def _lookup_path(son, path):
+    """Returns the value at the dotted ``path`` of ``son`` or None."""
+    value = son
+    for key in path.split('.'):
+        if isinstance(value, list):
+            try:
+                value = value[int(key)]
+            except (ValueError, IndexError):
+                return None
+        elif isinstance(value, dict):
+            value = value.get(key)
+        else:
+            return None
+    return value
+
 
 class BaseDocumentFormSet(BaseFormSet):
 
@@ -684,9 +1096,10 @@ class BaseDocumentFormSet(BaseFormSet):
 
     def construct_initial(self):
         initial = []
+        raw_initial = self.form._meta.raw_initial
         try:
             for d in self.get_queryset():
-                initial.append(document_to_dict(d))
+                initial.append(document_to_dict(d, raw_initial=raw_initial))
         except TypeError:
             pass
         return initial
@@ -705,6 +1118,7 @@ class BaseDocumentFormSet(BaseFormSet):
         obj = form.save(commit=False)
         return obj
 
+    @instrumented('formset.save')
     def save(self, commit=True):
         """
         Saves model instances for every form, adding and changing instances
@@ -716,6 +1130,8 @@ class BaseDocumentFormSet(BaseFormSet):
                 continue
             obj = self.save_object(form)
             if form.cleaned_data.get("DELETE", False):
+                if hasattr(obj, 'delete'):
+                    query('delete')
                 try:
                     obj.delete()
                 except AttributeError:
@@ -723,10 +1139,24 @@ class BaseDocumentFormSet(BaseFormSet):
                     # just don't add to the list and it's gone. Cool huh?
                     continue
             if commit:
-                obj.save()
+                query('save')
+                try:
+                    obj.save()
+                except (NotUniqueError, DuplicateKeyError) as e:
+                    if not form._meta.trust_unique_indexes or \
+                            not form._update_unique_errors(e):
+                        raise
+                    raise ValueError("The %s could not be saved because "
+                                     "the data didn't validate." %
+                                     obj.__class__.__name__)
             saved.append(obj)
         return saved
 
+    def full_clean(self):
+        if self.is_bound:
+            _resolve_generic_references(self.forms)
+        super(BaseDocumentFormSet, self).full_clean()
+
     def clean(self):
         self.validate_unique()
 
@@ -760,14 +1190,43 @@ def documentformset_factory(document, form=DocumentForm,
                             max_num=None, fields=None, exclude=None):
     """
     Returns a FormSet class for the given Django model class.
+
+    FormSet classes are cached like the form classes of
+    ``documentform_factory``.
     """
-    form = documentform_factory(document, form=form, fields=fields,
-                                exclude=exclude,
-                                formfield_callback=formfield_callback)
+    return _documentformset_factory(document, form, formfield_callback,
+                                    formset, extra, can_delete, can_order,
+                                    max_num, fields, exclude)
+
+
+def _documentformset_factory(document, form=DocumentForm,
+                             formfield_callback=None,
+                             formset=BaseDocumentFormSet,
+                             extra=1, can_delete=False, can_order=False,
+                             max_num=None, fields=None, exclude=None,
+                             embedded_field=None):
+    key = None
+    if isinstance(document, type):
+        key = make_cache_key('documentformset', document, form,
+                             formfield_callback, formset, extra, can_delete,
+                             can_order, max_num, fields, exclude,
+                             embedded_field)
+    if key is not None:
+        FormSet = _formset_classes.get(key)
+        if FormSet is not None:
+            return FormSet
+
+    form = _documentform_factory(document, form=form, fields=fields,
+                                 exclude=exclude,
+                                 formfield_callback=formfield_callback,
+                                 embedded_field=embedded_field)
     FormSet = formset_factory(form, formset, extra=extra, max_num=max_num,
                               can_order=can_order, can_delete=can_delete)
     FormSet.model = document
     FormSet.document = document
+    # only publish the class once it is complete
+    if key is not None:
+        _formset_classes.set(key, FormSet)
     return FormSet
 
 
@@ -917,6 +1376,7 @@ class EmbeddedDocumentFormSet(BaseDocumentFormSet):
             else:
                 setattr(
                     self.parent_document, self.form._meta.embedded_field, objs)
+            query('save')
             self.parent_document.save()
 
         return objs
@@ -924,32 +1384,29 @@ class EmbeddedDocumentFormSet(BaseDocumentFormSet):
 
 def _get_embedded_field(parent_doc, document, emb_name=None, can_fail=False):
     if emb_name:
-        emb_fields = [
-            f for f in parent_doc._fields.values() if f.name == emb_name]
-        if len(emb_fields) == 1:
-            field = emb_fields[0]
-            if not isinstance(field, (EmbeddedDocumentField, ListField)) or \
-                (isinstance(field, EmbeddedDocumentField) and
-                    field.document_type != document) or \
-                (isinstance(field, ListField) and
-                    isinstance(field.field, EmbeddedDocumentField) and
-                    field.field.document_type != document):
-                raise Exception(
-                    "emb_name '%s' is not a EmbeddedDocumentField or not a ListField to %s" % (
-                        emb_name, document
-                    )
+        field = parent_doc._fields.get(emb_name)
+        if field is None:
+            raise Exception("%s has no field named '%s'" %
+                            (parent_doc, emb_name))
+        if not isinstance(field, (EmbeddedDocumentField, ListField)) or \
+            (isinstance(field, EmbeddedDocumentField) and
+                field.document_type != document) or \
+            (isinstance(field, ListField) and
+                isinstance(field.field, EmbeddedDocumentField) and
+                field.field.document_type != document):
+            raise Exception(
+                "emb_name '%s' is not a EmbeddedDocumentField or not a ListField to %s" % (
+                    emb_name, document
                 )
-            elif len(emb_fields) == 0:
-                raise Exception("%s has no field named '%s'" %
-                                (parent_doc, emb_name))
+            )
     else:
         emb_fields = [
             f for f in parent_doc._fields.values()
-            if (isinstance(field, EmbeddedDocumentField) and
-                field.document_type == document) or
-               (isinstance(field, ListField) and
-                isinstance(field.field, EmbeddedDocumentField) and
-                field.field.document_type == document)
+            if (isinstance(f, EmbeddedDocumentField) and
+                f.document_type == document) or
+               (isinstance(f, ListField) and
+                isinstance(f.field, EmbeddedDocumentField) and
+                f.field.document_type == document)
         ]
         if len(emb_fields) == 1:
             field = emb_fields[0]
@@ -978,6 +1435,17 @@ def embeddedformset_factory(document, parent_document,
     You must provide ``fk_name`` if ``model`` has more than one ``ForeignKey``
     to ``parent_model``.
     """
+    key = None
+    if isinstance(parent_document, type):
+        key = make_cache_key('embeddedformset', document, parent_document,
+                             form, formset, embedded_name, fields, exclude,
+                             extra, can_order, can_delete, max_num,
+                             formfield_callback)
+    if key is not None:
+        FormSet = _formset_classes.get(key)
+        if FormSet is not None:
+            return FormSet
+
     emb_field = _get_embedded_field(parent_document, document, emb_name=embedded_name)
     if isinstance(emb_field, EmbeddedDocumentField):
         max_num = 1
@@ -991,7 +1459,11 @@ def embeddedformset_factory(document, parent_document,
         'fields': fields,
         'exclude': exclude,
         'max_num': max_num,
+        # form classes are shared, so the embedded field has to be set
+        # when the form is created
+        'embedded_field': emb_field.name,
     }
-    FormSet = documentformset_factory(document, **kwargs)
-    FormSet.form._meta.embedded_field = emb_field.name
+    FormSet = _documentformset_factory(document, **kwargs)
+    if key is not None:
+        _formset_classes.set(key, FormSet)
     return FormSet
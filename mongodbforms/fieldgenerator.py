@@ -4,7 +4,7 @@
 Based on django mongotools (https://github.com/wpjunior/django-mongotools) by
 Wilson Júnior (wilsonpjunior@gmail.com).
 """
-import collections
+import threading
 
 from django import forms
 from django.core.validators import EMPTY_VALUES, RegexValidator
@@ -22,16 +22,19 @@ except ImportError:
 from django.utils.text import capfirst
 
 from mongoengine import (ReferenceField as MongoReferenceField,
+                         StringField as MongoStringField,
                          EmbeddedDocumentField as MongoEmbeddedDocumentField,
+                         GenericReferenceField as MongoGenericReferenceField,
                          ListField as MongoListField,
                          MapField as MongoMapField)
 
 from mongodbforms.fields import (MongoCharField, MongoEmailField,
                                  MongoURLField, ReferenceField,
                                  DocumentMultipleChoiceField, ListField,
-                                 MapField)
+                                 MapField, TypedChoiceField,
+                                 MultipleChoiceField, GenericReferenceField)
 from mongodbforms.widgets import Html5SplitDateTimeWidget
-from mongodbforms.documentoptions import create_verbose_name
+from mongodbforms.documentoptions import create_verbose_name, FrozenDict
 
 BLANK_CHOICE_DASH = [("", "---------")]
 
@@ -48,20 +51,21 @@ class MongoFormFieldGenerator(object):
 
     form_field_map = {
         'stringfield': MongoCharField,
-        'stringfield_choices': forms.TypedChoiceField,
+        'stringfield_choices': TypedChoiceField,
         'stringfield_long': MongoCharField,
         'emailfield': MongoEmailField,
         'urlfield': MongoURLField,
         'intfield': forms.IntegerField,
-        'intfield_choices': forms.TypedChoiceField,
+        'intfield_choices': TypedChoiceField,
         'floatfield': forms.FloatField,
         'decimalfield': forms.DecimalField,
         'booleanfield': forms.BooleanField,
-        'booleanfield_choices': forms.TypedChoiceField,
+        'booleanfield_choices': TypedChoiceField,
         'datetimefield': forms.SplitDateTimeField,
         'referencefield': ReferenceField,
+        'genericreferencefield': GenericReferenceField,
         'listfield': ListField,
-        'listfield_choices': forms.MultipleChoiceField,
+        'listfield_choices': MultipleChoiceField,
         'listfield_references': DocumentMultipleChoiceField,
         'mapfield': MapField,
         'filefield': forms.FileField,
@@ -73,9 +77,20 @@ class MongoFormFieldGenerator(object):
         'stringfield_long': forms.Textarea,
     }
 
-    def __init__(self, field_overrides={}, widget_overrides={}):
-        self.form_field_map.update(field_overrides)
-        self.widget_override_map.update(widget_overrides)
+    # Reference fields to collections with more documents than this use the
+    # search mode of the form fields instead of rendering every document.
+    # None disables the check, which needs a database round trip per field
+    # when a form class is created.
+    reference_search_threshold = None
+
+    def __init__(self, field_overrides=None, widget_overrides=None):
+        # The maps on the class are only defaults. Every instance gets its
+        # own copy, so overrides never leak into other generators.
+        self.form_field_map = dict(self.form_field_map)
+        self.form_field_map.update(field_overrides or {})
+
+        self.widget_override_map = dict(self.widget_override_map)
+        self.widget_override_map.update(widget_overrides or {})
 
     def generate(self, field, **kwargs):
         """Tries to lookup a matching formfield generator (lowercase
@@ -140,18 +155,14 @@ class MongoFormFieldGenerator(object):
             return ''
 
     def get_field_default(self, field):
+        """
+        Returns the default of the field as the form field's initial value.
+        Callable defaults are not called here, the form calls them when the
+        initial value of a bound field is used.
+        """
         if isinstance(field, (MongoListField, MongoMapField)):
-            f = field.field
-        else:
-            f = field
-        d = {}
-        if isinstance(f.default, collections.Callable):
-            d['initial'] = field.default()
-            d['show_hidden_initial'] = True
-            return f.default()
-        else:
-            d['initial'] = field.default
-        return f.default
+            return field.field.default
+        return field.default
 
     def check_widget(self, map_key):
         if map_key in self.widget_override_map:
@@ -310,6 +321,44 @@ class MongoFormFieldGenerator(object):
         defaults.update(kwargs)
         return form_class(**defaults)
 
+    def get_reference_search_fields(self, document):
+        """
+        Returns the ``search_fields`` for the form field of a reference to
+        ``document`` if the collection is larger than
+        ``reference_search_threshold``, otherwise None. Prefers a text index,
+        then indexed string fields, then the first string field.
+        """
+        if self.reference_search_threshold is None:
+            return None
+        try:
+            collection = document._get_collection()
+            if hasattr(collection, 'estimated_document_count'):
+                count = collection.estimated_document_count()
+            else:
+                # pymongo < 3.7
+                count = collection.count()
+        except Exception:
+            # no connection (yet), use a normal select
+            return None
+        if count <= self.reference_search_threshold:
+            return None
+
+        index_specs = document._meta.get('index_specs', None) or []
+        string_fields = [name for name in document._fields_ordered
+                         if isinstance(document._fields[name],
+                                       MongoStringField)]
+        reverse_map = getattr(document, '_reverse_db_field_map', {})
+        indexed = []
+        for spec in index_specs:
+            for db_field, direction in spec['fields']:
+                if direction == 'text':
+                    return '$text'
+            # a prefix search can only use an index on the first field
+            name = reverse_map.get(spec['fields'][0][0], spec['fields'][0][0])
+            if name in string_fields and name not in indexed:
+                indexed.append(name)
+        return tuple(indexed) or tuple(string_fields[:1]) or None
+
     def generate_referencefield(self, field, **kwargs):
         map_key = 'referencefield'
         defaults = {
@@ -318,6 +367,28 @@ class MongoFormFieldGenerator(object):
             'required': field.required,
             'queryset': field.document_type.objects.clone(),
         }
+        search_fields = self.get_reference_search_fields(field.document_type)
+        if search_fields:
+            defaults['search_fields'] = search_fields
+        form_class = self.form_field_map.get(map_key)
+        defaults.update(self.check_widget(map_key))
+        defaults.update(kwargs)
+        return form_class(**defaults)
+
+    def generate_genericreferencefield(self, field, **kwargs):
+        # Without choices no document class is allowed, a form field could
+        # never validate. Declare it on the form with document_types instead.
+        if not field.choices and not kwargs.get('document_types'):
+            return
+
+        map_key = 'genericreferencefield'
+        defaults = {
+            'label': self.get_field_label(field),
+            'help_text': self.get_field_help_text(field),
+            'required': field.required,
+            # mongoengine uses the choices for the allowed document classes
+            'document_types': field.choices,
+        }
         form_class = self.form_field_map.get(map_key)
         defaults.update(self.check_widget(map_key))
         defaults.update(kwargs)
@@ -334,7 +405,14 @@ class MongoFormFieldGenerator(object):
             'help_text': self.get_field_help_text(field),
             'required': field.required,
         }
-        if field.field.choices:
+        if isinstance(field.field, MongoGenericReferenceField):
+            # the allowed document classes are the choices of the field,
+            # they are passed with the contained field
+            map_key = 'listfield'
+            defaults['contained_field'] = self.generate(field.field)
+            if defaults['contained_field'] is None:
+                return
+        elif field.field.choices:
             map_key = 'listfield_choices'
             defaults.update({
                 'choices': field.field.choices,
@@ -345,6 +423,10 @@ class MongoFormFieldGenerator(object):
             defaults.update({
                 'queryset': field.field.document_type.objects.clone(),
             })
+            search_fields = self.get_reference_search_fields(
+                field.field.document_type)
+            if search_fields:
+                defaults['search_fields'] = search_fields
         else:
             map_key = 'listfield'
             form_field = self.generate(field.field)
@@ -364,6 +446,8 @@ class MongoFormFieldGenerator(object):
 
         map_key = 'mapfield'
         form_field = self.generate(field.field)
+        if form_field is None:
+            return
         defaults = {
             'label': self.get_field_label(field),
             'help_text': self.get_field_help_text(field),
@@ -432,6 +516,18 @@ class MongoDefaultFormFieldGenerator(MongoFormFieldGenerator):
             return forms.CharField(**defaults)
 
 
+def _html5_input(name, input_type):
+    # Django < 1.6 has no HTML5 inputs. Don't change TextInput itself, that
+    # would change every text input in the process.
+    if hasattr(forms, name):
+        return getattr(forms, name)
+    return type(name, (forms.TextInput, ), {'input_type': input_type})
+
+EmailInput = _html5_input('EmailInput', 'email')
+NumberInput = _html5_input('NumberInput', 'number')
+URLInput = _html5_input('URLInput', 'url')
+
+
 class Html5FormFieldGenerator(MongoDefaultFormFieldGenerator):
     def check_widget(self, map_key):
         override = super(Html5FormFieldGenerator, self).check_widget(map_key)
@@ -442,27 +538,62 @@ class Html5FormFieldGenerator(MongoDefaultFormFieldGenerator):
         kind = chunks[0]
 
         if kind == 'email':
-            if hasattr(forms, 'EmailInput'):
-                return {'widget': forms.EmailInput}
-            else:
-                input = forms.TextInput
-                input.input_type = 'email'
-                return {'widget': input}
+            return {'widget': EmailInput}
         elif kind in ['int', 'float'] and len(chunks) < 2:
-            if hasattr(forms, 'NumberInput'):
-                return {'widget': forms.NumberInput}
-            else:
-                input = forms.TextInput
-                input.input_type = 'number'
-                return {'widget': input}
+            return {'widget': NumberInput}
         elif kind == 'url':
-            if hasattr(forms, 'URLInput'):
-                return {'widget': forms.URLInput}
-            else:
-                input = forms.TextInput
-                input.input_type = 'url'
-                return {'widget': input}
+            return {'widget': URLInput}
         elif kind == 'datetime':
             return {'widget': Html5SplitDateTimeWidget}
         else:
             return {}
+
+
+_generators = {}
+_generators_lock = threading.Lock()
+
+
+def _overrides_key(overrides):
+    if not overrides:
+        return frozenset()
+    return frozenset(overrides.items())
+
+
+def _create_generator(generator_class, kwargs):
+    generator = generator_class(**kwargs)
+    # the maps can only be changed in __init__, changing them later would
+    # change every form sharing the generator
+    for name in ('generator_map', 'form_field_map', 'widget_override_map'):
+        setattr(generator, name, FrozenDict(getattr(generator, name)))
+    return generator
+
+
+def get_field_generator(generator_class, field_overrides=None,
+                        widget_overrides=None):
+    """
+    Returns an instance of ``generator_class`` for the given overrides.
+    Instances are created once per (class, overrides) and shared, so their
+    maps are frozen once ``__init__`` returned. The overrides are only
+    passed if they are given, generators without these arguments keep
+    working.
+    """
+    kwargs = {}
+    if field_overrides:
+        kwargs['field_overrides'] = field_overrides
+    if widget_overrides:
+        kwargs['widget_overrides'] = widget_overrides
+    try:
+        key = (generator_class, _overrides_key(field_overrides),
+               _overrides_key(widget_overrides))
+        hash(key)
+    except TypeError:
+        # unhashable overrides, can't be cached
+        return _create_generator(generator_class, kwargs)
+    generator = _generators.get(key)
+    if generator is None:
+        with _generators_lock:
+            generator = _generators.get(key)
+            if generator is None:
+                generator = _generators[key] = _create_generator(
+                    generator_class, kwargs)
+    return generator
@@ -38,22 +38,51 @@ try:  # objectid was moved into bson in pymongo 1.9
 except ImportError:
     from pymongo.errors import InvalidId
 
-from mongodbforms.widgets import ListWidget, MapWidget, HiddenMapWidget
+try:
+    from bson.dbref import DBRef
+except ImportError:
+    from pymongo.dbref import DBRef
+
+try:
+    from mongoengine.base import LazyReference
+except ImportError:
+    # mongoengine < 0.15
+    LazyReference = None
+from mongoengine.base import get_document
+from mongoengine.document import Document
+try:
+    from mongoengine.base import ValidationError as MongoValidationError
+except ImportError:
+    from mongoengine.errors import ValidationError as MongoValidationError
+
+from mongoengine.queryset import Q
+
+from mongodbforms.widgets import (ListWidget, MapWidget, HiddenMapWidget,
+                                  ReferenceSearchSelect,
+                                  ReferenceSearchSelectMultiple)
+from mongodbforms.instrumentation import query
+from mongodbforms.util import string_types, integer_types, text_type
 
 
 class MongoChoiceIterator(object):
     def __init__(self, field):
         self.field = field
-        self.queryset = field.queryset
+
+    @property
+    def queryset(self):
+        # clones the queryset, so only do it when the choices are used
+        return self.field.queryset
 
     def __iter__(self):
         if self.field.empty_label is not None:
             yield ("", self.field.empty_label)
 
+        query('find')
         for obj in self.queryset.all():
             yield self.choice(obj)
 
     def __len__(self):
+        query('count')
         return len(self.queryset)
 
     def choice(self, obj):
@@ -90,15 +119,77 @@ class MongoURLField(NormalizeValueMixin, forms.URLField):
     pass
 
 
+class SharedChoicesMixin(object):
+    """
+    Stores the choices of a choice field as a tuple and shares them between
+    all copies of the field, instead of deep copying them for every form
+    instance. Setting new choices on a copy only changes that copy.
+    """
+    def __init__(self, *args, **kwargs):
+        super(SharedChoicesMixin, self).__init__(*args, **kwargs)
+        if isinstance(self._choices, list):
+            self._choices = self.widget.choices = tuple(self._choices)
+
+    def __deepcopy__(self, memo):
+        result = forms.Field.__deepcopy__(self, memo)
+        if isinstance(self._choices, tuple):
+            result._choices = self._choices
+        else:
+            result._choices = copy.deepcopy(self._choices, memo)
+        return result
+
+
+class TypedChoiceField(SharedChoicesMixin, forms.TypedChoiceField):
+    pass
+
+
+class MultipleChoiceField(SharedChoicesMixin, forms.MultipleChoiceField):
+    pass
+
+
+def _to_pk(document, value):
+    pk_field = document._fields[document._meta.get('id_field', 'id')]
+    try:
+        pk = pk_field.to_python(value)
+        pk_field.validate(pk)
+    except (TypeError, ValueError, InvalidId, MongoValidationError):
+        return None
+    return pk
+
+
 class ReferenceField(forms.ChoiceField):
     """
     Reference field for mongo forms. Inspired by
     `django.forms.models.ModelChoiceField`.
+
+    If ``lazy`` is True, ``clean`` returns a lazy reference (a
+    ``LazyReference`` or, for old mongoengine versions, a ``DBRef``) instead
+    of loading the referenced document. The existence of the document is
+    checked with a query for its id only, or not at all if ``check_exists``
+    is False.
+
+    If ``search_fields`` is given, the field works in search mode for large
+    collections: the widget renders only the selected documents and
+    ``search`` returns pages of candidates whose ``search_fields`` start
+    with a search term (``'$text'`` uses the text index instead).
     """
+    search_widget = ReferenceSearchSelect
+
     def __init__(self, queryset, empty_label="---------", *args, **kwargs):
+        self.lazy = kwargs.pop('lazy', False)
+        self.check_exists = kwargs.pop('check_exists', True)
+        search_fields = kwargs.pop('search_fields', None)
+        if isinstance(search_fields, string_types):
+            search_fields = (search_fields, )
+        self.search_fields = search_fields and tuple(search_fields)
+        self.page_size = kwargs.pop('page_size', 20)
+        if self.search_fields and kwargs.get('widget') is None:
+            kwargs['widget'] = self.search_widget
         forms.Field.__init__(self, *args, **kwargs)
         self.empty_label = empty_label
         self.queryset = queryset
+        if hasattr(self.widget, 'selected_choices'):
+            self.widget.selected_choices = self.selected_choices
 
     def _get_queryset(self):
         return self._queryset.clone()
@@ -111,9 +202,24 @@ class ReferenceField(forms.ChoiceField):
     def prepare_value(self, value):
         if hasattr(value, '_meta'):
             return value.pk
+        # not dereferenced initial data, see document_to_dict
+        if isinstance(value, DBRef):
+            return value.id
 
         return super(ReferenceField, self).prepare_value(value)
 
+    def _has_changed(self, initial, data):
+        initial = self.prepare_value(initial)
+        initial = '' if initial is None else force_unicode(initial)
+        data = '' if data is None else force_unicode(data)
+        return initial != data
+
+    def has_changed(self, initial, data):
+        # Django 1.8+ calls has_changed. Disabled fields never change.
+        if getattr(self, 'disabled', False):
+            return False
+        return self._has_changed(initial, data)
+
     def _get_choices(self):
         return MongoChoiceIterator(self)
     choices = property(_get_choices, forms.ChoiceField._set_choices)
@@ -137,6 +243,16 @@ class ReferenceField(forms.ChoiceField):
 
         oid = super(ReferenceField, self).clean(value)
 
+        if self.lazy:
+            pk = self.to_pk(oid)
+            if pk is None or (self.check_exists and
+                              pk not in self.existing_pks([pk])):
+                raise forms.ValidationError(
+                    self.error_messages['invalid_choice'] % {'value': value}
+                )
+            return self.make_reference(pk)
+
+        query('get')
         try:
             obj = self.queryset.get(pk=oid)
         except (TypeError, InvalidId, self.queryset._document.DoesNotExist):
@@ -145,9 +261,90 @@ class ReferenceField(forms.ChoiceField):
             )
         return obj
 
+    def validate(self, value):
+        # clean checks the submitted value with a query, ChoiceField would
+        # iterate over the whole queryset to find it in the choices.
+        forms.Field.validate(self, value)
+
+    def to_pk(self, value):
+        """
+        Converts a submitted value to the type of the primary key of the
+        referenced document. Returns None if it isn't a valid key.
+        """
+        return _to_pk(self._queryset._document, value)
+
+    def existing_pks(self, pks):
+        """
+        Returns the set of ``pks`` that are in the queryset. Loads only the
+        ids of the documents.
+        """
+        query('find')
+        return set(self.queryset.filter(pk__in=list(pks)).scalar('pk'))
+
+    def make_reference(self, pk):
+        document = self._queryset._document
+        if LazyReference is not None:
+            return LazyReference(document, pk)
+        return DBRef(document._get_collection_name(), pk)
+
+    def selected_choices(self, value):
+        """
+        Returns the choices for the selected ``value`` (or list of values)
+        only. Used by the widget in search mode.
+        """
+        values = value if isinstance(value, (list, tuple)) else [value]
+        choices = []
+        if self.empty_label is not None:
+            choices.append(("", self.empty_label))
+        documents = [v for v in values if hasattr(v, '_meta')]
+        # the single value prepare_value, also for multiple choice fields
+        pks = [self.to_pk(ReferenceField.prepare_value(self, v))
+               for v in values
+               if v not in EMPTY_VALUES and not hasattr(v, '_meta')]
+        pks = [pk for pk in pks if pk is not None]
+        if pks:
+            query('find')
+            documents.extend(self.queryset.filter(pk__in=pks))
+        choices.extend((obj.pk, self.label_from_instance(obj))
+                       for obj in documents)
+        return choices
+
+    def search(self, term, page=1):
+        """
+        Returns the ``(value, label)`` choices of one page of documents
+        matching ``term`` and whether there are more pages. Pages start at 1.
+        """
+        qs = self.queryset
+        if term and self.search_fields == ('$text', ):
+            qs = qs.search_text(term)
+        elif term:
+            q = None
+            for name in self.search_fields or ():
+                field_q = Q(**{'%s__startswith' % name: term})
+                q = field_q if q is None else q | field_q
+            if q is not None:
+                qs = qs.filter(q)
+        try:
+            page = max(int(page), 1)
+        except (TypeError, ValueError):
+            # page comes from the query string
+            page = 1
+        start = (page - 1) * self.page_size
+        query('find')
+        # one more to know if there is a next page
+        objs = list(qs.skip(start).limit(self.page_size + 1))
+        choices = [(obj.pk, self.label_from_instance(obj))
+                   for obj in objs[:self.page_size]]
+        return choices, len(objs) > self.page_size
+
     def __deepcopy__(self, memo):
         result = super(forms.ChoiceField, self).__deepcopy__(memo)
-        result.queryset = self.queryset  # self.queryset calls clone()
+        # The queryset is cloned every time it is read, so the stored one
+        # never changes and can be shared by all copies.
+        result._queryset = self._queryset
+        result.widget.choices = result.choices
+        if hasattr(result.widget, 'selected_choices'):
+            result.widget.selected_choices = result.selected_choices
         result.empty_label = copy.deepcopy(self.empty_label)
         return result
 
@@ -156,6 +353,7 @@ class DocumentMultipleChoiceField(ReferenceField):
     """A MultipleChoiceField whose choices are a model QuerySet."""
     widget = forms.SelectMultiple
     hidden_widget = forms.MultipleHiddenInput
+    search_widget = ReferenceSearchSelectMultiple
     default_error_messages = {
         'list': _('Enter a list of values.'),
         'invalid_choice': _('Select a valid choice. %s is not one of the'
@@ -176,6 +374,23 @@ class DocumentMultipleChoiceField(ReferenceField):
         if not isinstance(value, (list, tuple)):
             raise forms.ValidationError(self.error_messages['list'])
 
+        if self.lazy:
+            pks = [self.to_pk(val) for val in value]
+            for val, pk in zip(value, pks):
+                if pk is None:
+                    raise forms.ValidationError(
+                        self.error_messages['invalid_pk_value'] % val
+                    )
+            if self.check_exists:
+                existing = self.existing_pks(pks)
+                for val, pk in zip(value, pks):
+                    if pk not in existing:
+                        raise forms.ValidationError(
+                            self.error_messages['invalid_choice'] % val
+                        )
+            self.run_validators(value)
+            return [self.make_reference(pk) for pk in pks]
+
         qs = self.queryset
         try:
             qs = qs.filter(pk__in=value)
@@ -183,6 +398,7 @@ class DocumentMultipleChoiceField(ReferenceField):
             raise forms.ValidationError(
                 self.error_messages['invalid_pk_value'] % str(value)
             )
+        query('find')
         pks = set([force_unicode(getattr(o, 'pk')) for o in qs])
         for val in value:
             if force_unicode(val) not in pks:
@@ -195,13 +411,365 @@ class DocumentMultipleChoiceField(ReferenceField):
         return list(qs)
 
     def prepare_value(self, value):
-        if hasattr(value, '__iter__') and not hasattr(value, '_meta'):
+        if hasattr(value, '__iter__') and not hasattr(value, '_meta') and \
+                not isinstance(value, DBRef):
             sup = super(DocumentMultipleChoiceField, self)
             return [sup.prepare_value(v) for v in value]
         return super(DocumentMultipleChoiceField, self).prepare_value(value)
 
+    def _has_changed(self, initial, data):
+        initial = self.prepare_value(initial or [])
+        initial = set(force_unicode(value) for value in initial)
+        data = set(force_unicode(value) for value in data or [])
+        return initial != data
+
+
+def resolve_generic_references(keys):
+    """
+    Loads the documents for ``(document class, pk)`` pairs with one ``$in``
+    query per document class. Returns a dict mapping ``(class name, pk)`` to
+    the document, or to None if it doesn't exist.
+    """
+    pks_by_document = {}
+    resolved = {}
+    for document, pk in keys:
+        pks_by_document.setdefault(document, set()).add(pk)
+        resolved[(document._class_name, pk)] = None
+    for document, pks in pks_by_document.items():
+        query('find')
+        for obj in document.objects.filter(pk__in=list(pks)):
+            resolved[(document._class_name, obj.pk)] = obj
+    return resolved
+
+
+class GenericChoiceIterator(object):
+    def __init__(self, field):
+        self.field = field
+
+    def __iter__(self):
+        if self.field.empty_label is not None:
+            yield ("", self.field.empty_label)
+
+        for document in self.field.document_types:
+            query('find')
+            for obj in document.objects.all():
+                yield (self.field.prepare_value(obj),
+                       self.field.label_from_instance(obj))
+
+
+class GenericReferenceField(forms.ChoiceField):
+    """
+    Form field for a mongoengine ``GenericReferenceField``. The values are
+    ``<document class name>:<pk>``. Only documents of ``document_types`` can
+    be referenced, they are also the choices. Without document types a text
+    input is used and every reference is invalid.
+
+    Document forms and formsets resolve the submitted references of all
+    their generic reference fields at once, with one ``$in`` query per
+    document class. See ``resolve_generic_references``.
+    """
+    def __init__(self, document_types=None, empty_label="---------", *args,
+                 **kwargs):
+        self.document_types = tuple(
+            get_document(d) if isinstance(d, string_types) else d
+            for d in document_types or ())
+        if not self.document_types and kwargs.get('widget') is None:
+            kwargs['widget'] = forms.TextInput
+        forms.Field.__init__(self, *args, **kwargs)
+        self.empty_label = empty_label
+        # documents resolved in advance, see resolve_generic_references
+        self.resolved = None
+        self.widget.choices = self.choices
+
+    def _get_choices(self):
+        return GenericChoiceIterator(self)
+    choices = property(_get_choices, forms.ChoiceField._set_choices)
+
+    def label_from_instance(self, obj):
+        return smart_unicode(obj)
+
+    def prepare_value(self, value):
+        if hasattr(value, '_meta'):
+            return '%s:%s' % (value._class_name, value.pk)
+        # the stored value
+        if isinstance(value, dict) and '_cls' in value:
+            return '%s:%s' % (value['_cls'], value['_ref'].id)
+        return super(GenericReferenceField, self).prepare_value(value)
+
+    def to_key(self, value):
+        """
+        Converts a submitted value to a ``(document class, pk)`` pair.
+        Returns None if the value isn't valid.
+        """
+        try:
+            class_name, pk = force_unicode(value).split(':', 1)
+        except ValueError:
+            return None
+        # only the allowed classes, never any document named in the data
+        document = next((d for d in self.document_types
+                         if d._class_name == class_name), None)
+        # embedded documents can't be referenced
+        if document is None or not issubclass(document, Document):
+            return None
+        pk = _to_pk(document, pk)
+        if pk is None:
+            return None
+        return document, pk
+
+    def validate(self, value):
+        # clean checks the submitted value with a query
+        forms.Field.validate(self, value)
+
+    def clean(self, value):
+        return self._clean(value, self.resolved)
+
+    def clean_batch(self, values, max_errors=None):
+        """
+        Cleans the values of a list field with one query per document class,
+        see ``get_batch_cleaner``.
+        """
+        resolved = dict(self.resolved or {})
+        keys = [self.to_key(v) for v in values if v not in self.empty_values]
+        keys = [k for k in keys
+                if k is not None and (k[0]._class_name, k[1]) not in resolved]
+        if keys:
+            resolved.update(resolve_generic_references(keys))
+        clean_data = []
+        errors = []
+        for index, value in enumerate(values):
+            try:
+                # like ListField: only the first element may be required
+                if index and value in self.empty_values:
+                    value = None
+                else:
+                    value = self._clean(value, resolved)
+            except ValidationError as e:
+                errors.append((index, e))
+                if max_errors is not None and len(errors) >= max_errors:
+                    break
+                continue
+            clean_data.append(value)
+        return clean_data, errors
+
+    def _clean(self, value, resolved):
+        value = self.to_python(value)
+        self.validate(value)
+        if value in EMPTY_VALUES:
+            return None
+        self.run_validators(value)
+
+        key = self.to_key(value)
+        obj = None
+        if key is not None:
+            document, pk = key
+            if resolved is None or (document._class_name, pk) not in resolved:
+                resolved = resolve_generic_references([key])
+            obj = resolved[(document._class_name, pk)]
+        if obj is None:
+            raise forms.ValidationError(
+                self.error_messages['invalid_choice'] % {'value': value}
+            )
+        return obj
 
-class ListField(forms.Field):
+    def __deepcopy__(self, memo):
+        result = super(forms.ChoiceField, self).__deepcopy__(memo)
+        result.widget.choices = result.choices
+        return result
+
+
+def _clean_first_or_optional(field, index, value):
+    """
+    Mirrors the element-wise path of ``ListField.clean``: only the first
+    element of a list honors ``required``, all following empty values are
+    converted without a required check.
+    """
+    if index == 0:
+        return field.clean(value)
+    return field.to_python(value)
+
+
+def _clean_batch(field, values, convert, fast_types, max_errors=None):
+    clean_data = []
+    errors = []
+    empty_values = field.empty_values
+    run_validators = bool(field.validators)
+    for index, value in enumerate(values):
+        try:
+            if value in empty_values:
+                value = _clean_first_or_optional(field, index, value)
+            else:
+                value = convert(value) if type(value) in fast_types else None
+                if value is None:
+                    # anything unusual goes through the field itself to get
+                    # the exact same result and error messages
+                    value = field.clean(values[index])
+                elif run_validators:
+                    field.run_validators(value)
+        except ValidationError as e:
+            errors.append((index, e))
+            if max_errors is not None and len(errors) >= max_errors:
+                break
+            continue
+        clean_data.append(value)
+    return clean_data, errors
+
+
+def _to_int(value):
+    try:
+        return int(value)
+    except (ValueError, TypeError):
+        return None
+
+
+def _to_float(value):
+    try:
+        value = float(value)
+    except (ValueError, TypeError):
+        return None
+    # nan and inf are handled differently between Django versions
+    if value - value != 0:
+        return None
+    return value
+
+
+def _to_text(value):
+    if value.strip() != value:
+        return None
+    return value
+
+
+# only values of exactly these types take the fast path
+_TEXT_TYPES = (text_type, )
+_INTEGER_TYPES = integer_types + (text_type, )
+_FLOAT_TYPES = integer_types + (float, text_type)
+
+
+def clean_integer_batch(field, values, max_errors=None):
+    return _clean_batch(field, values, _to_int, _INTEGER_TYPES, max_errors)
+
+
+def clean_float_batch(field, values, max_errors=None):
+    return _clean_batch(field, values, _to_float, _FLOAT_TYPES, max_errors)
+
+
+def clean_text_batch(field, values, max_errors=None):
+    return _clean_batch(field, values, _to_text, _TEXT_TYPES, max_errors)
+
+
+# batch cleaners for Django's form fields. Only exact classes are listed,
+# subclasses may change the way a single value is cleaned.
+BATCH_CLEANERS = {
+    forms.IntegerField: clean_integer_batch,
+    forms.FloatField: clean_float_batch,
+    forms.CharField: clean_text_batch,
+    MongoCharField: clean_text_batch,
+}
+
+
+def get_batch_cleaner(field):
+    """
+    Returns a function ``cleaner(values, max_errors=None)`` that cleans a
+    whole list of values for ``field`` or None if the field has no batch
+    support.
+
+    Form fields can implement ``clean_batch(values, max_errors=None)``
+    themselves. It has to return a tuple ``(clean_data, errors)`` where errors
+    is a list of ``(index, ValidationError)`` pairs in index order. Cleaning
+    stops as soon as ``max_errors`` errors were found.
+    """
+    if hasattr(field, 'clean_batch'):
+        return field.clean_batch
+    if getattr(field, 'localize', False):
+        return None
+    cleaner = BATCH_CLEANERS.get(type(field))
+    if cleaner is None:
+        return None
+    return lambda values, max_errors=None: cleaner(field, values, max_errors)
+
+
+class ContainerValidationError(ValidationError):
+    """
+    Raised by ``ListField`` and ``MapField``. Behaves like a normal
+    ValidationError with all messages in a flat list, but also keeps the
+    errors per element in ``element_errors``, a list of
+    ``(index_or_key, ErrorList)`` pairs.
+
+    ``truncated`` is True if validation stopped early because the field's
+    ``max_errors`` was reached.
+    """
+    def __init__(self, element_errors, truncated_message=None):
+        self.element_errors = element_errors
+        self.truncated = truncated_message is not None
+        messages = []
+        for key, errors in element_errors:
+            messages.extend(errors)
+        if self.truncated:
+            messages.append(truncated_message)
+        super(ContainerValidationError, self).__init__(messages)
+
+
+class ContainerFieldMixin(object):
+    """
+    Error handling shared by ``ListField`` and ``MapField``.
+
+    ``max_errors`` limits how many elements may fail validation before
+    cleaning stops. That bounds the work done for broken or hostile
+    submissions with lots of invalid elements. None means no limit.
+    """
+    default_error_messages = {
+        'too_many_errors': _('Validation stopped after %(max_errors)d '
+                             'errors.'),
+    }
+
+    def _max_errors_reached(self, element_errors):
+        return self.max_errors is not None and \
+            len(element_errors) >= self.max_errors
+
+    def _raise_element_errors(self, element_errors, truncated=False):
+        """
+        Raises the collected errors. ``truncated`` means that elements were
+        left unchecked because ``max_errors`` was reached.
+        """
+        if not element_errors:
+            return
+        truncated_message = None
+        if truncated:
+            truncated_message = self.error_messages['too_many_errors'] % {
+                'max_errors': self.max_errors
+            }
+        raise ContainerValidationError(element_errors, truncated_message)
+
+    def __deepcopy__(self, memo):
+        result = super(ContainerFieldMixin, self).__deepcopy__(memo)
+        # clean changes the contained field, every form needs its own
+        result.contained_field = copy.deepcopy(self.contained_field, memo)
+        return result
+
+    def has_changed(self, initial, data):
+        # Django 1.8+ calls has_changed. Disabled fields never change.
+        if getattr(self, 'disabled', False):
+            return False
+        return self._has_changed(initial, data)
+
+    def _contained_has_changed(self, initial, data):
+        # Django 1.8 renamed _has_changed to has_changed
+        field = self.contained_field
+        if hasattr(field, 'has_changed'):
+            return field.has_changed(initial, data)
+        return field._has_changed(initial, data)
+
+    def _fingerprint(self, value):
+        """
+        Normalizes a single initial or submitted value to text, so that
+        unchanged containers can be detected with one comparison.
+        """
+        value = self.contained_field.prepare_value(value)
+        if value is None:
+            return ''
+        return force_unicode(value)
+
+
+class ListField(ContainerFieldMixin, forms.Field):
     default_error_messages = {
         'invalid': _('Enter a list of values.'),
     }
@@ -209,6 +777,7 @@ class ListField(forms.Field):
     hidden_widget = forms.MultipleHiddenInput
 
     def __init__(self, contained_field, *args, **kwargs):
+        self.max_errors = kwargs.pop('max_errors', None)
         if 'widget' in kwargs:
             self.widget = kwargs.pop('widget')
 
@@ -235,8 +804,6 @@ class ListField(forms.Field):
         pass
 
     def clean(self, value):
-        clean_data = []
-        errors = ErrorList()
         if not value or isinstance(value, (list, tuple)):
             if not value or not [
                     v for v in value if v not in self.empty_values
@@ -248,29 +815,66 @@ class ListField(forms.Field):
         else:
             raise ValidationError(self.error_messages['invalid'])
 
-        for field_value in value:
-            try:
-                clean_data.append(self.contained_field.clean(field_value))
-            except ValidationError as e:
-                # Collect all validation errors in a single list, which we'll
-                # raise at the end of clean(), rather than raising a single
-                # exception for the first error we encounter.
-                errors.extend(e.messages)
-            if self.contained_field.required:
-                self.contained_field.required = False
-        if errors:
-            raise ValidationError(errors)
+        cleaner = get_batch_cleaner(self.contained_field)
+        if cleaner is None:
+            cleaner = self._clean_elements
+        clean_data, element_errors = cleaner(value, self.max_errors)
+        # cleaning stops at the error that reached max_errors, so elements
+        # were skipped if that wasn't the last one
+        truncated = self._max_errors_reached(element_errors) and \
+            element_errors[-1][0] < len(value) - 1
+        # Collect all validation errors, which we'll raise at the end of
+        # clean(), rather than raising a single exception for the first
+        # error we encounter.
+        self._raise_element_errors([
+            (index, ErrorList(e.messages)) for index, e in element_errors
+        ], truncated)
 
         self.validate(clean_data)
         self.run_validators(clean_data)
         return clean_data
 
+    def _clean_elements(self, value, max_errors=None):
+        """
+        Cleans ``value`` one element at a time. Used if the contained field
+        has no batch cleaner, see ``get_batch_cleaner``.
+        """
+        clean_data = []
+        errors = []
+        required = self.contained_field.required
+        try:
+            for index, field_value in enumerate(value):
+                try:
+                    clean_data.append(self.contained_field.clean(field_value))
+                except ValidationError as e:
+                    errors.append((index, e))
+                    if max_errors is not None and len(errors) >= max_errors:
+                        break
+                if self.contained_field.required:
+                    self.contained_field.required = False
+        finally:
+            # only the first element is required, but don't leak that
+            # into the next call of clean()
+            self.contained_field.required = required
+        return clean_data, errors
+
     def _has_changed(self, initial, data):
+        data = [] if data is None else data
         if initial is None:
             initial = ['' for x in range(0, len(data))]
 
+        if len(initial) != len(data):
+            return True
+
+        # cheap check first. Only if the normalized values differ the
+        # contained field has to decide (e.g. for 1.0 vs '1')
+        fingerprint = self._fingerprint
+        if [fingerprint(v) for v in initial] == \
+                [fingerprint(v) for v in data]:
+            return False
+
         for initial, data in zip(initial, data):
-            if self.contained_field._has_changed(initial, data):
+            if self._contained_has_changed(initial, data):
                 return True
         return False
 
@@ -283,7 +887,7 @@ class ListField(forms.Field):
         return prep_val
 
 
-class MapField(forms.Field):
+class MapField(ContainerFieldMixin, forms.Field):
     default_error_messages = {
         'invalid': _('Enter a list of values.'),
         'key_required': _('A key is required.'),
@@ -292,8 +896,9 @@ class MapField(forms.Field):
     hidden_widget = HiddenMapWidget
 
     def __init__(self, contained_field, max_key_length=None,
-                 min_key_length=None, key_validators=[], field_kwargs={},
+                 min_key_length=None, key_validators=None, field_kwargs=None,
                  *args, **kwargs):
+        self.max_errors = kwargs.pop('max_errors', None)
         if 'widget' in kwargs:
             self.widget = kwargs.pop('widget')
 
@@ -309,16 +914,18 @@ class MapField(forms.Field):
         super(MapField, self).__init__(*args, **kwargs)
 
         if isinstance(contained_field, type):
-            field_kwargs['required'] = self.required
+            field_kwargs = dict(field_kwargs or {}, required=self.required)
             self.contained_field = contained_field(**field_kwargs)
         else:
             self.contained_field = contained_field
 
-        self.key_validators = key_validators
+        # a tuple per field, the arguments must not be changed
+        key_validators = list(key_validators or ())
         if min_key_length is not None:
-            self.key_validators.append(MinLengthValidator(int(min_key_length)))
+            key_validators.append(MinLengthValidator(int(min_key_length)))
         if max_key_length is not None:
-            self.key_validators.append(MaxLengthValidator(int(max_key_length)))
+            key_validators.append(MaxLengthValidator(int(max_key_length)))
+        self.key_validators = tuple(key_validators)
 
         # type of field used to store the dicts value
         if not hasattr(self, 'empty_values'):
@@ -346,7 +953,6 @@ class MapField(forms.Field):
 
     def clean(self, value):
         clean_data = {}
-        errors = ErrorList()
         if not value or isinstance(value, dict):
             if not value or not [
                     v for v in value.values() if v not in self.empty_values
@@ -359,40 +965,62 @@ class MapField(forms.Field):
             raise ValidationError(self.error_messages['invalid'])
 
         # sort out required => at least one element must be in there
-        for key, val in value.items():
-            # ignore empties. Can they even come up here?
-            if key in self.empty_values and val in self.empty_values:
-                continue
+        element_errors = []
+        truncated = False
+        required = self.contained_field.required
+        try:
+            for position, (key, val) in enumerate(value.items()):
+                # ignore empties. Can they even come up here?
+                if key in self.empty_values and val in self.empty_values:
+                    continue
+
+                # Collect all validation errors, which we'll raise at the end
+                # of clean(), rather than raising a single exception for the
+                # first error we encounter.
+                errors = ErrorList()
+                try:
+                    val = self.contained_field.clean(val)
+                except ValidationError as e:
+                    errors.extend(e.messages)
 
-            try:
-                val = self.contained_field.clean(val)
-            except ValidationError as e:
-                # Collect all validation errors in a single list, which we'll
-                # raise at the end of clean(), rather than raising a single
-                # exception for the first error we encounter.
-                errors.extend(e.messages)
+                try:
+                    self._validate_key(key)
+                except ValidationError as e:
+                    errors.extend(e.messages)
 
-            try:
-                self._validate_key(key)
-            except ValidationError as e:
-                # Collect all validation errors in a single list, which we'll
-                # raise at the end of clean(), rather than raising a single
-                # exception for the first error we encounter.
-                errors.extend(e.messages)
+                clean_data[key] = val
 
-            clean_data[key] = val
+                if self.contained_field.required:
+                    self.contained_field.required = False
 
-            if self.contained_field.required:
-                self.contained_field.required = False
+                if errors:
+                    element_errors.append((key, errors))
+                    if self._max_errors_reached(element_errors):
+                        truncated = position < len(value) - 1
+                        break
+        finally:
+            self.contained_field.required = required
 
-        if errors:
-            raise ValidationError(errors)
+        self._raise_element_errors(element_errors, truncated)
 
         self.validate(clean_data)
         self.run_validators(clean_data)
         return clean_data
 
     def _has_changed(self, initial, data):
+        data = {} if data is None else data
+        if initial is not None:
+            if len(initial) != len(data):
+                return True
+
+            fingerprint = self._fingerprint
+            try:
+                if all(fingerprint(initial[k]) == fingerprint(v)
+                       for k, v in data.items()):
+                    return False
+            except KeyError:
+                return True
+
         for k, v in data.items():
             if initial is None:
                 init_val = ''
@@ -401,6 +1029,6 @@ class MapField(forms.Field):
                     init_val = initial[k]
                 except KeyError:
                     return True
-            if self.contained_field._has_changed(init_val, v):
+            if self._contained_has_changed(init_val, v):
                 return True
         return False
@@ -0,0 +1,208 @@
+"""
+Timers and counters for the hot paths of mongodbforms.
+
+Nothing is measured unless a listener is registered::
+
+    from mongodbforms import instrumentation
+
+    instrumentation.add_listener(instrumentation.LoggingCollector())
+
+Every measured phase is reported as a span with its duration in seconds and
+the counters (database round trips) incremented while it ran. Spans nest,
+a counter is added to all spans that are active in the current thread.
+"""
+import logging
+import threading
+import time
+from collections import defaultdict
+from functools import wraps
+
+try:
+    _timer = time.perf_counter
+except AttributeError:
+    # Python 2
+    _timer = time.time
+
+_listeners = ()
+_listeners_lock = threading.Lock()
+_local = threading.local()
+
+
+def add_listener(listener):
+    """Registers a listener, see ``Listener`` for the interface."""
+    global _listeners
+    with _listeners_lock:
+        if listener not in _listeners:
+            _listeners = _listeners + (listener, )
+
+
+def remove_listener(listener):
+    global _listeners
+    with _listeners_lock:
+        _listeners = tuple(l for l in _listeners if l is not listener)
+
+
+def is_enabled():
+    return bool(_listeners)
+
+
+class Listener(object):
+    """Base class for listeners. Both methods do nothing by default."""
+
+    def span(self, name, duration, counts, tags):
+        """
+        Called when a span finished. ``counts`` maps counter names to the
+        value they were incremented by during the span.
+        """
+        pass
+
+    def count(self, name, value, tags):
+        """Called every time a counter is incremented."""
+        pass
+
+
+class _NoopSpan(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+_noop_span = _NoopSpan()
+
+
+class Span(object):
+    __slots__ = ('name', 'tags', 'counts', 'start', 'duration')
+
+    def __init__(self, name, tags):
+        self.name = name
+        self.tags = tags
+        self.counts = defaultdict(int)
+        self.start = None
+        self.duration = None
+
+    def __enter__(self):
+        stack = getattr(_local, 'stack', None)
+        if stack is None:
+            stack = _local.stack = []
+        stack.append(self)
+        self.start = _timer()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.duration = _timer() - self.start
+        _local.stack.remove(self)
+        counts = dict(self.counts)
+        for listener in _listeners:
+            listener.span(self.name, self.duration, counts, self.tags)
+        return False
+
+
+def span(name, **tags):
+    """
+    Returns a context manager measuring the code it wraps. Returns a shared
+    no-op context manager if no listener is registered.
+    """
+    if not _listeners:
+        return _noop_span
+    return Span(name, tags)
+
+
+def count(name, value=1, **tags):
+    """Increments the counter ``name``."""
+    if not _listeners:
+        return
+    for active in getattr(_local, 'stack', ()):
+        active.counts[name] += value
+    for listener in _listeners:
+        listener.count(name, value, tags)
+
+
+def query(operation, **tags):
+    """
+    Counts a database round trip. Increments ``db.<operation>`` and the
+    total ``db.queries``.
+    """
+    if not _listeners:
+        return
+    for active in getattr(_local, 'stack', ()):
+        active.counts['db.queries'] += 1
+    count('db.%s' % operation, **tags)
+
+
+def instrumented(name):
+    """Decorator that wraps every call of the function in a span."""
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            if not _listeners:
+                return func(*args, **kwargs)
+            with Span(name, {}):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+class MemoryCollector(Listener):
+    """
+    Aggregates spans and counters in memory. ``spans`` maps span names to
+    dicts with the ``calls``, the ``total`` time and the summed ``counts``.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.spans = defaultdict(
+                lambda: {'calls': 0, 'total': 0.0,
+                         'counts': defaultdict(int)})
+            self.counts = defaultdict(int)
+
+    def span(self, name, duration, counts, tags):
+        with self._lock:
+            stats = self.spans[name]
+            stats['calls'] += 1
+            stats['total'] += duration
+            for counter, value in counts.items():
+                stats['counts'][counter] += value
+
+    def count(self, name, value, tags):
+        with self._lock:
+            self.counts[name] += value
+
+
+class LoggingCollector(Listener):
+    """Logs every finished span."""
+
+    def __init__(self, logger=None, level=logging.DEBUG):
+        self.logger = logger or logging.getLogger('mongodbforms')
+        self.level = level
+
+    def span(self, name, duration, counts, tags):
+        if not self.logger.isEnabledFor(self.level):
+            return
+        counters = ' '.join('%s=%s' % item for item in sorted(counts.items()))
+        self.logger.log(self.level, '%s %.3fms %s', name, duration * 1000,
+                        counters)
+
+
+class StatsdCollector(Listener):
+    """
+    Sends spans as timers and counters as counters to a statsd style client,
+    any object with ``timing(name, msec)`` and ``incr(name, value)``.
+    """
+    def __init__(self, client, prefix='mongodbforms'):
+        self.client = client
+        self.prefix = prefix
+
+    def _name(self, name):
+        if self.prefix:
+            return '%s.%s' % (self.prefix, name)
+        return name
+
+    def span(self, name, duration, counts, tags):
+        self.client.timing(self._name(name), duration * 1000)
+
+    def count(self, name, value, tags):
+        self.client.incr(self._name(name), value)
@@ -0,0 +1,178 @@
+"""
+Query budgets for tests.
+
+Records the commands pymongo sends to the server and fails if a block of
+code sends more than expected::
+
+    from mongodbforms.testing import QueryBudgetMixin
+
+    class PostFormTest(QueryBudgetMixin, TestCase):
+        def test_save(self):
+            with self.assertMaxQueries(2):
+                form = PostForm(data)
+                form.is_valid()
+                form.save()
+
+The recorder uses pymongo's command monitoring. pymongo only passes events
+to listeners registered before a client is created, so import this module
+before mongoengine connects (e.g. in the test settings), or pass
+``command_listener`` to ``connect(..., event_listeners=[...])``.
+
+Clients that don't publish command events can't be recorded. mongomock is
+one of them, and so is a pymongo client created before this module was
+imported. A budget would pass for any code on such a client. If nothing was
+recorded while one of mongoengine's connections is such a client,
+``max_queries`` and ``assertMaxQueries`` fail and ``QueryRecorder`` warns.
+"""
+import threading
+import warnings
+
+from pymongo import monitoring
+
+# handshake, auth and session bookkeeping, not issued by forms
+IGNORED_COMMANDS = frozenset([
+    'ismaster', 'isMaster', 'hello', 'ping', 'buildinfo', 'buildInfo',
+    'saslStart', 'saslContinue', 'authenticate', 'getnonce',
+    'endSessions', 'killCursors',
+])
+
+_recorders = ()
+_recorders_lock = threading.Lock()
+
+
+class Query(object):
+    __slots__ = ('name', 'database', 'command')
+
+    def __init__(self, name, database, command):
+        self.name = name
+        self.database = database
+        self.command = command
+
+    def __repr__(self):
+        return '<Query %s.%s %r>' % (self.database, self.name,
+                                     self.command.get(self.name))
+
+
+class CommandListener(monitoring.CommandListener):
+    """Passes the commands started in a thread to its active recorders."""
+
+    def started(self, event):
+        if not _recorders or event.command_name in IGNORED_COMMANDS:
+            return
+        thread = threading.current_thread()
+        query = None
+        for recorder in _recorders:
+            if recorder.thread is not thread:
+                continue
+            if query is None:
+                query = Query(event.command_name, event.database_name,
+                              event.command)
+            recorder.queries.append(query)
+
+    def succeeded(self, event):
+        pass
+
+    def failed(self, event):
+        pass
+
+command_listener = CommandListener()
+monitoring.register(command_listener)
+
+
+def unmonitored_connections():
+    """
+    Returns the aliases of mongoengine's connections whose commands don't
+    reach ``command_listener``.
+    """
+    try:
+        from mongoengine.connection import _connections
+    except ImportError:
+        return []
+    aliases = []
+    for alias, client in list(_connections.items()):
+        if not type(client).__module__.startswith('pymongo'):
+            # e.g. mongomock
+            aliases.append(alias)
+            continue
+        options = getattr(client, 'options', None)
+        listeners = getattr(options, 'event_listeners', None)
+        if listeners is not None and command_listener not in listeners:
+            aliases.append(alias)
+    return aliases
+
+
+class QueryRecorder(object):
+    """
+    Context manager recording the commands sent by the current thread while
+    it is active. ``queries`` is a list of ``Query`` objects with the command
+    ``name`` (``find``, ``insert``, ``count``...), the ``database`` and the
+    ``command`` document.
+    """
+    def __init__(self):
+        self.queries = []
+        self.thread = None
+
+    def __len__(self):
+        return len(self.queries)
+
+    def __enter__(self):
+        global _recorders
+        self.queries = []
+        self.thread = threading.current_thread()
+        with _recorders_lock:
+            _recorders = _recorders + (self, )
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        global _recorders
+        with _recorders_lock:
+            _recorders = tuple(r for r in _recorders if r is not self)
+        if exc_type is None and not self.queries:
+            aliases = unmonitored_connections()
+            if aliases:
+                self.unmonitored('No queries recorded, but the connections %s '
+                                 "don't publish command events, so queries "
+                                 'can\'t be recorded.' % ', '.join(aliases))
+        return False
+
+    def unmonitored(self, message):
+        warnings.warn(message, RuntimeWarning, stacklevel=3)
+
+
+class _MaxQueriesContext(QueryRecorder):
+    def __init__(self, num, fail):
+        super(_MaxQueriesContext, self).__init__()
+        self.num = num
+        self.fail = fail
+
+    def unmonitored(self, message):
+        self.fail(message)
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        super(_MaxQueriesContext, self).__exit__(exc_type, exc_value,
+                                                 traceback)
+        if exc_type is not None or len(self.queries) <= self.num:
+            return False
+        self.fail('%d queries executed, at most %d expected\n%s' % (
+            len(self.queries), self.num,
+            '\n'.join('%d. %r' % (i, q)
+                      for i, q in enumerate(self.queries, start=1))))
+
+
+def _fail(message):
+    raise AssertionError(message)
+
+
+def max_queries(num):
+    """
+    Returns a context manager that raises ``AssertionError`` if the code it
+    wraps sends more than ``num`` commands to MongoDB.
+    """
+    return _MaxQueriesContext(num, _fail)
+
+
+class QueryBudgetMixin(object):
+    """Adds ``assertMaxQueries`` to a ``TestCase``."""
+
+    def assertMaxQueries(self, num):
+        return _MaxQueriesContext(num, self.fail)
@@ -1,4 +1,11 @@
 # -*- coding: utf-8 -*-
+import copy
+import os
+import subprocess
+import sys
+import unittest
+import warnings
+
 from django.conf import settings
 
 settings.configure(
@@ -20,8 +27,37 @@ settings.configure(
 
 
 import mongoengine
+from bson import DBRef, ObjectId
+from mongoengine.errors import NotUniqueError
+from mongoengine.queryset import QuerySet
+from pymongo.errors import DuplicateKeyError
+try:
+    import mongomock
+except ImportError:
+    mongomock = None
+from django import forms
+from django.core.exceptions import ValidationError
 from django.test import SimpleTestCase
-from mongodbforms.documentoptions import LazyDocumentMetaWrapper
+from mongodbforms.documentoptions import (LazyDocumentMetaWrapper, PkWrapper,
+                                          get_document_meta,
+                                          document_meta_stats, flatten_choices)
+from mongodbforms.util import get_document_options, init_document_options
+from mongodbforms.documents import (documentform_factory,
+                                    documentformset_factory,
+                                    embeddedformset_factory, document_to_dict,
+                                    _reference_list_filter,
+                                    _duplicate_key_fields, _lookup_path,
+                                    OperationError,
+                                    DocumentForm, EmbeddedDocumentForm)
+from mongodbforms.fieldgenerator import (MongoFormFieldGenerator,
+                                         get_field_generator)
+from mongodbforms.fields import (ListField, MapField, TypedChoiceField,
+                                 ReferenceField, DocumentMultipleChoiceField,
+                                 GenericReferenceField)
+import mongodbforms
+from mongodbforms import documents, instrumentation
+from mongodbforms.testing import (QueryBudgetMixin, QueryRecorder,
+                                  command_listener)
 
 
 class TestDocument(mongoengine.Document):
@@ -48,3 +84,868 @@ class LazyWrapperTest(SimpleTestCase):
         meta = LazyDocumentMetaWrapper(TestDocument)
         meta.custom = 'yes'
         self.assertEqual(meta.custom, 'yes')
+
+
+class ListFieldBatchCleanTest(SimpleTestCase):
+
+    def test_batch_clean_integers(self):
+        field = ListField(forms.IntegerField, required=True)
+        self.assertEqual(field.clean(['1', 2, '', '4']), [1, 2, None, 4])
+
+    def test_batch_clean_errors_match_element_wise(self):
+        values = ['1', 'x', '2', 'y']
+        field = ListField(forms.IntegerField)
+        with self.assertRaises(ValidationError) as batch:
+            field.clean(values)
+
+        field = ListField(forms.IntegerField)
+        clean_data, errors = field._clean_elements(values)
+        self.assertEqual([i for i, e in errors], [1, 3])
+        self.assertEqual(batch.exception.messages,
+                         [m for i, e in errors for m in e.messages])
+
+    def test_element_wise_keeps_required(self):
+        field = ListField(forms.EmailField, required=True)
+        field.clean(['a@example.com', 'b@example.com'])
+        self.assertTrue(field.contained_field.required)
+
+
+class ContainerErrorsTest(SimpleTestCase):
+
+    def test_list_errors_by_index(self):
+        field = ListField(forms.IntegerField)
+        with self.assertRaises(ValidationError) as cm:
+            field.clean(['1', 'x', '2', 'y'])
+        self.assertEqual([i for i, e in cm.exception.element_errors], [1, 3])
+        self.assertFalse(cm.exception.truncated)
+
+    def test_list_max_errors(self):
+        field = ListField(forms.IntegerField, max_errors=2)
+        with self.assertRaises(ValidationError) as cm:
+            field.clean(['x'] * 1000)
+        self.assertEqual(len(cm.exception.element_errors), 2)
+        self.assertTrue(cm.exception.truncated)
+        self.assertEqual(len(cm.exception.messages), 3)
+
+    def test_max_errors_on_last_element(self):
+        # every element was checked, so validation didn't stop early
+        field = ListField(forms.IntegerField, max_errors=2)
+        with self.assertRaises(ValidationError) as cm:
+            field.clean(['1', 'x', 'y'])
+        self.assertFalse(cm.exception.truncated)
+        self.assertEqual(len(cm.exception.messages), 2)
+
+    def test_positional_arguments(self):
+        field = MapField(forms.IntegerField, 3, 1, max_errors=2)
+        self.assertEqual(len(field.key_validators), 2)
+        self.assertEqual(field.max_errors, 2)
+
+    def test_map_errors_by_key(self):
+        field = MapField(forms.IntegerField, max_key_length=3, max_errors=1)
+        with self.assertRaises(ValidationError) as cm:
+            field.clean({'long_key': 'x'})
+        key, errors = cm.exception.element_errors[0]
+        self.assertEqual(key, 'long_key')
+        self.assertEqual(len(errors), 2)
+        self.assertFalse(cm.exception.truncated)
+
+    def test_map_key_validators_not_shared(self):
+        field_kwargs = {}
+        for i in range(3):
+            field = MapField(forms.IntegerField, max_key_length=3,
+                             min_key_length=1, field_kwargs=field_kwargs)
+        self.assertEqual(len(field.key_validators), 2)
+        self.assertEqual(field_kwargs, {})
+
+
+class ContainerHasChangedTest(SimpleTestCase):
+
+    def changed_data(self, field, initial, data):
+        form_class = type('ContainerForm', (forms.Form, ), {'c': field})
+        form = form_class(data, initial={'c': initial})
+        return form.has_changed(), form.changed_data
+
+    def test_list_has_changed(self):
+        field = ListField(forms.IntegerField)
+        self.assertEqual(self.changed_data(field, [1, 2],
+                                           {'c_0': '1', 'c_1': '2'}),
+                         (False, []))
+        self.assertEqual(self.changed_data(field, [1, 2],
+                                           {'c_0': '1', 'c_1': '3'}),
+                         (True, ['c']))
+        self.assertEqual(self.changed_data(field, [1, 2], {
+            'c_0': '1', 'c_1': '2', 'c_2': '3'}), (True, ['c']))
+
+    def test_map_has_changed(self):
+        field = MapField(forms.IntegerField)
+        self.assertEqual(self.changed_data(field, {'a': 1},
+                                           {'c_key_0': 'a', 'c_value_0': '1'}),
+                         (False, []))
+        self.assertEqual(self.changed_data(field, {'a': 1},
+                                           {'c_key_0': 'b', 'c_value_0': '1'}),
+                         (True, ['c']))
+        self.assertEqual(self.changed_data(field, {'a': 1, 'b': 2},
+                                           {'c_key_0': 'a', 'c_value_0': '1'}),
+                         (True, ['c']))
+
+    def test_disabled(self):
+        field = ListField(forms.CharField(), disabled=True)
+        self.assertFalse(field.has_changed(['a'], ['b']))
+        field = MapField(forms.CharField(), disabled=True)
+        self.assertFalse(field.has_changed({'a': 'a'}, {'a': 'b'}))
+
+
+class PkWrapperTest(SimpleTestCase):
+
+    def test_attributes(self):
+        field = mongoengine.ObjectIdField(required=True)
+        pk = PkWrapper(field)
+        pk.name = 'id'
+        self.assertEqual(field.name, 'id')
+        self.assertTrue(pk.required)
+        self.assertFalse(pk.editable)
+        self.assertRaises(AttributeError, getattr, pk, 'no_such_attribute')
+
+        # changes to the field are not hidden by a cached value
+        field.required = False
+        self.assertFalse(pk.required)
+        self.assertEqual(pk.validate, field.validate)
+
+        pk = PkWrapper(None)
+        pk.editable = True
+        self.assertTrue(pk.editable)
+        self.assertRaises(AttributeError, getattr, pk, 'name')
+
+
+class RegistryDocument(mongoengine.Document):
+    meta = {'app_label': 'mongodbforms'}
+
+    name = mongoengine.StringField()
+
+
+class ChoicesDocument(mongoengine.Document):
+    meta = {'app_label': 'mongodbforms'}
+
+    status_code = mongoengine.StringField(
+        choices=(('a', 'A'), ('Group', (('b', 'B'), ))))
+    parent = mongoengine.ReferenceField(RegistryDocument)
+
+
+class DocumentMetaRegistryTest(SimpleTestCase):
+
+    def test_wrapper_built_once(self):
+        built = document_meta_stats()['built']
+        meta = get_document_meta(RegistryDocument)
+        self.assertTrue(get_document_options(RegistryDocument) is meta)
+        init_document_options(RegistryDocument)
+        self.assertTrue(RegistryDocument._meta is meta)
+        self.assertTrue(LazyDocumentMetaWrapper(RegistryDocument).pk is meta.pk)
+        self.assertEqual(document_meta_stats()['built'], built + 1)
+
+
+class FieldIndexTest(SimpleTestCase):
+
+    def test_field_lookups(self):
+        meta = get_document_meta(RegistryDocument)
+        self.assertEqual(meta.get_field_by_name('name'),
+                         (RegistryDocument._fields['name'], None, True, False))
+        self.assertEqual([f.name for f in meta.get_fields()], ['id', 'name'])
+        self.assertEqual(meta.get_reference_fields(), ())
+        self.assertFalse(hasattr(meta, 'no_such_option'))
+
+    def test_immutable(self):
+        index = get_document_meta(RegistryDocument).field_index
+        self.assertRaises(TypeError, index.by_name.__setitem__, 'name', None)
+        self.assertRaises(TypeError, index.flatchoices.update, {})
+
+
+class LazyFieldAttributesTest(SimpleTestCase):
+
+    def test_django_field_attributes(self):
+        get_document_meta(ChoicesDocument)
+        status = ChoicesDocument._fields['status_code']
+        self.assertEqual(status.flatchoices, [('a', 'A'), ('b', 'B')])
+        # flattened once, shared with the field index
+        self.assertTrue(get_document_meta(ChoicesDocument).get_flatchoices(
+            'status_code') is status.flatchoices)
+        self.assertEqual(status.verbose_name, 'Status code')
+        self.assertTrue(isinstance(status.verbose_name, str))
+        self.assertFalse(status.is_relation)
+        self.assertTrue(status.rel is None)
+        self.assertFalse(status.auto_created)
+
+        parent = ChoicesDocument._fields['parent']
+        self.assertTrue(parent.is_relation)
+        self.assertTrue(parent.rel.to is RegistryDocument)
+
+    def test_plain_choices(self):
+        self.assertEqual(flatten_choices(['a', 'b']), [('a', 'a'), ('b', 'b')])
+
+    def test_other_fields_untouched(self):
+        field = mongoengine.ListField(mongoengine.StringField())
+        self.assertFalse(hasattr(field, 'rel'))
+        self.assertFalse(hasattr(field, 'flatchoices'))
+
+
+class FieldGeneratorTest(SimpleTestCase):
+
+    def test_overrides_dont_leak(self):
+        generator = MongoFormFieldGenerator(
+            field_overrides={'intfield': forms.CharField})
+        self.assertEqual(generator.form_field_map['intfield'], forms.CharField)
+        self.assertEqual(MongoFormFieldGenerator().form_field_map['intfield'],
+                         forms.IntegerField)
+        generator.form_field_map['intfield'] = forms.FloatField
+        self.assertEqual(MongoFormFieldGenerator.form_field_map['intfield'],
+                         forms.IntegerField)
+
+    def test_generator_without_arguments(self):
+        class PlainGenerator(MongoFormFieldGenerator):
+            def __init__(self):
+                super(PlainGenerator, self).__init__()
+                self.form_field_map['intfield'] = forms.CharField
+
+        generator = get_field_generator(PlainGenerator)
+        self.assertEqual(generator.form_field_map['intfield'], forms.CharField)
+
+    def test_shared_maps_are_frozen(self):
+        generator = get_field_generator(MongoFormFieldGenerator)
+        for name in ('generator_map', 'form_field_map',
+                     'widget_override_map'):
+            self.assertRaises(TypeError, getattr(generator, name).__setitem__,
+                              'intfield', forms.CharField)
+        self.assertRaises(TypeError, generator.form_field_map.update,
+                          {'intfield': forms.CharField})
+        self.assertEqual(generator.form_field_map['intfield'],
+                         forms.IntegerField)
+
+    def test_shared_instances(self):
+        overrides = {'intfield': forms.CharField}
+        generator = get_field_generator(MongoFormFieldGenerator, overrides)
+        self.assertTrue(
+            get_field_generator(MongoFormFieldGenerator, dict(overrides)) is
+            generator)
+        self.assertFalse(get_field_generator(MongoFormFieldGenerator) is
+                         generator)
+
+
+class CallableDefaultTest(SimpleTestCase):
+
+    def test_lazy_default(self):
+        calls = []
+
+        def default():
+            calls.append(1)
+            return 'now'
+
+        field = MongoFormFieldGenerator().generate(
+            mongoengine.StringField(max_length=10, default=default))
+        self.assertTrue(field.initial is default)
+        self.assertEqual(calls, [])
+
+        form_class = type('DefaultForm', (forms.Form, ), {'when': field})
+        form = form_class()
+        self.assertEqual(calls, [])
+        self.assertTrue('value="now"' in str(form['when']))
+        self.assertEqual(form['when'].value(), 'now')
+        self.assertEqual(calls, [1])
+
+
+class SharedChoicesTest(SimpleTestCase):
+
+    def test_copies_share_choices(self):
+        field = TypedChoiceField(choices=[('a', 'A'), ('b', 'B')])
+        field_copy = copy.deepcopy(field)
+        self.assertTrue(field_copy.choices is field.choices)
+        self.assertTrue(field_copy.widget.choices is field.choices)
+
+        field_copy.choices = [('c', 'C')]
+        self.assertEqual(list(field.choices), [('a', 'A'), ('b', 'B')])
+        self.assertEqual(field_copy.clean('c'), 'c')
+
+
+class ExpensiveDocument(mongoengine.Document):
+    meta = {'app_label': 'mongodbforms'}
+
+    name = mongoengine.StringField()
+
+    def __init__(self, *args, **kwargs):
+        raise AssertionError('the factory must not instantiate documents')
+
+
+class DocumentFormFactoryTest(SimpleTestCase):
+
+    def test_cached_form_class(self):
+        form_class = documentform_factory(ExpensiveDocument, fields=['name'])
+        self.assertEqual(form_class.__name__, 'ExpensiveDocumentForm')
+        self.assertTrue(
+            documentform_factory(ExpensiveDocument, fields=['name']) is
+            form_class)
+        self.assertFalse(documentform_factory(ExpensiveDocument) is
+                         form_class)
+
+
+class Comment(mongoengine.EmbeddedDocument):
+    text = mongoengine.StringField()
+
+
+class Post(mongoengine.Document):
+    meta = {'app_label': 'mongodbforms'}
+
+    comments = mongoengine.ListField(mongoengine.EmbeddedDocumentField(Comment))
+
+
+class FormSetFactoryTest(SimpleTestCase):
+
+    def test_cached_formset_classes(self):
+        formset = documentformset_factory(Post, extra=2)
+        self.assertTrue(documentformset_factory(Post, extra=2) is formset)
+        self.assertFalse(documentformset_factory(Post, extra=3) is formset)
+
+    def test_embedded_formset(self):
+        formset = embeddedformset_factory(Comment, Post)
+        self.assertTrue(embeddedformset_factory(Comment, Post) is formset)
+        self.assertEqual(formset.form._meta.embedded_field, 'comments')
+
+
+class PackageExportsTest(SimpleTestCase):
+
+    def test_exports(self):
+        for name in ('CharField', 'DocumentForm', 'Html5FormFieldGenerator',
+                     'with_metaclass'):
+            self.assertTrue(name in mongodbforms.__all__)
+            self.assertTrue(hasattr(mongodbforms, name))
+        self.assertRaises(AttributeError, getattr, mongodbforms,
+                          'no_such_name')
+
+    def test_star_names_in_fresh_interpreter(self):
+        # names only the old star imports exported resolve before anything
+        # else touched the package
+        code = (
+            'from django.conf import settings\n'
+            'settings.configure()\n'
+            'from mongodbforms import (ListField, MapField, ReferenceField, '
+            'MongoCharField, DocumentMultipleChoiceField, '
+            'DocumentMetaWrapper, ErrorList)\n'
+        )
+        root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        process = subprocess.Popen([sys.executable, '-c', code], cwd=root,
+                                   stderr=subprocess.PIPE)
+        stderr = process.communicate()[1]
+        self.assertEqual(process.returncode, 0, stderr)
+
+
+class InstrumentationTest(SimpleTestCase):
+
+    def test_disabled(self):
+        self.assertFalse(instrumentation.is_enabled())
+        self.assertTrue(instrumentation.span('test') is
+                        instrumentation.span('other'))
+
+    def test_collect_spans(self):
+        collector = instrumentation.MemoryCollector()
+        instrumentation.add_listener(collector)
+        try:
+            with instrumentation.span('outer'):
+                instrumentation.query('count')
+                with instrumentation.span('inner'):
+                    instrumentation.query('get')
+        finally:
+            instrumentation.remove_listener(collector)
+
+        self.assertEqual(collector.spans['outer']['calls'], 1)
+        self.assertEqual(collector.spans['outer']['counts']['db.queries'], 2)
+        self.assertEqual(collector.spans['inner']['counts']['db.queries'], 1)
+        self.assertEqual(collector.counts['db.get'], 1)
+
+
+class FakeCommandEvent(object):
+    database_name = 'test'
+
+    def __init__(self, command_name):
+        self.command_name = command_name
+        self.command = {command_name: 'test_document'}
+
+
+class QueryBudgetTest(QueryBudgetMixin, SimpleTestCase):
+
+    def test_recorder(self):
+        with QueryRecorder() as recorder:
+            command_listener.started(FakeCommandEvent('find'))
+            command_listener.started(FakeCommandEvent('isMaster'))
+        command_listener.started(FakeCommandEvent('count'))
+        self.assertEqual([q.name for q in recorder.queries], ['find'])
+
+    def test_max_queries(self):
+        with self.assertMaxQueries(1):
+            command_listener.started(FakeCommandEvent('find'))
+        with self.assertRaises(AssertionError):
+            with self.assertMaxQueries(1):
+                command_listener.started(FakeCommandEvent('find'))
+                command_listener.started(FakeCommandEvent('count'))
+
+    def test_unmonitored_client(self):
+        # a client without command events, like mongomock
+        connections = mongoengine.connection._connections
+        connections['unmonitored'] = object()
+        try:
+            with self.assertRaises(AssertionError):
+                with self.assertMaxQueries(1):
+                    pass
+            with warnings.catch_warnings(record=True) as caught:
+                warnings.simplefilter('always')
+                with QueryRecorder():
+                    pass
+            self.assertEqual(len(caught), 1)
+            with self.assertMaxQueries(1):
+                command_listener.started(FakeCommandEvent('find'))
+        finally:
+            del connections['unmonitored']
+
+
+class Author(mongoengine.Document):
+    name = mongoengine.StringField()
+
+
+class Book(mongoengine.Document):
+    author = mongoengine.ReferenceField(Author, dbref=True)
+    co_authors = mongoengine.ListField(mongoengine.ReferenceField(Author))
+
+
+class RawInitialTest(SimpleTestCase):
+
+    def setUp(self):
+        self.author_id = ObjectId()
+        self.co_author_ids = [ObjectId(), ObjectId()]
+        self.book = Book._from_son({
+            '_id': ObjectId(),
+            'author': DBRef('author', self.author_id),
+            'co_authors': self.co_author_ids,
+        })
+
+    def test_document_to_dict(self):
+        # dereferencing would fail, there is no database connection
+        data = document_to_dict(self.book, raw_initial=True)
+        self.assertEqual(data['author'], DBRef('author', self.author_id))
+        field = DocumentMultipleChoiceField(None)
+        self.assertEqual(field.prepare_value(data['co_authors']),
+                         self.co_author_ids)
+
+    def test_prepare_value(self):
+        # the querysets are not used
+        field = ReferenceField(None)
+        self.assertEqual(field.prepare_value(DBRef('author', self.author_id)),
+                         self.author_id)
+        self.assertFalse(field.has_changed(DBRef('author', self.author_id),
+                                           str(self.author_id)))
+        field = DocumentMultipleChoiceField(None)
+        self.assertFalse(field.has_changed(
+            self.co_author_ids, [str(pk) for pk in self.co_author_ids]))
+
+
+class UniqueReferenceListTest(SimpleTestCase):
+
+    def test_filter(self):
+        refs = [ObjectId(), ObjectId()]
+        self.assertEqual(_reference_list_filter('authors', refs),
+                         {'authors__all': refs, 'authors__size': 2})
+        self.assertEqual(_reference_list_filter('authors', None),
+                         {'authors__size': 0})
+
+
+class Release(mongoengine.Document):
+    title = mongoengine.StringField(unique_with='year', db_field='t')
+    year = mongoengine.IntField()
+    slug = mongoengine.StringField(unique=True)
+
+
+class ReleaseForm(DocumentForm):
+    class Meta:
+        document = Release
+        trust_unique_indexes = True
+
+
+def duplicate_key_error(index, key_pattern=None):
+    error = DuplicateKeyError(
+        'E11000 duplicate key error collection: test.release index: %s '
+        'dup key: { : "x" }' % index, 11000,
+        {'keyPattern': key_pattern} if key_pattern else None)
+    try:
+        raise error
+    except DuplicateKeyError as e:
+        try:
+            raise NotUniqueError('Tried to save duplicate unique keys (%s)' %
+                                 e)
+        except NotUniqueError as e:
+            return e
+
+
+class UniqueIndexTest(SimpleTestCase):
+
+    def test_duplicate_key_fields(self):
+        self.assertEqual(
+            _duplicate_key_fields(Release, duplicate_key_error('t_1_year_1')),
+            ['title', 'year'])
+        self.assertEqual(
+            _duplicate_key_fields(Release, duplicate_key_error(
+                'custom', {'slug': 1})),
+            ['slug'])
+        self.assertEqual(
+            _duplicate_key_fields(Release, duplicate_key_error('unknown')),
+            [])
+
+    def test_save_maps_index_errors(self):
+        form = ReleaseForm({'title': 'x', 'year': '1', 'slug': 'x'})
+        # no pre-check queries, there is no database connection
+        self.assertTrue(form.is_valid())
+
+        def save(*args, **kwargs):
+            raise duplicate_key_error('t_1_year_1')
+        form.instance.save = save
+        self.assertRaises(ValueError, form.save)
+        self.assertEqual(list(form.errors), ['title'])
+
+
+class LazyReferenceFieldTest(SimpleTestCase):
+
+    def test_unchecked_reference(self):
+        # a queryset without collection, it must not be queried
+        field = ReferenceField(QuerySet(Author, None), lazy=True,
+                               check_exists=False)
+        pk = ObjectId()
+        reference = field.clean(str(pk))
+        self.assertTrue(isinstance(reference, DBRef))
+        self.assertEqual(reference.id, pk)
+        self.assertRaises(ValidationError, field.clean, 'invalid')
+
+    def test_disabled_has_changed(self):
+        pk = ObjectId()
+        field = ReferenceField(QuerySet(Author, None))
+        self.assertTrue(field.has_changed(pk, str(ObjectId())))
+        self.assertFalse(field.has_changed(pk, str(pk)))
+        field.disabled = True
+        self.assertFalse(field.has_changed(pk, str(ObjectId())))
+        field = DocumentMultipleChoiceField(QuerySet(Author, None))
+        self.assertTrue(field.has_changed([pk], [str(ObjectId())]))
+        self.assertFalse(field.has_changed([pk], [str(pk)]))
+        field.disabled = True
+        self.assertFalse(field.has_changed([pk], [str(ObjectId())]))
+
+
+class ReferenceSearchTest(SimpleTestCase):
+
+    def test_renders_selected_only(self):
+        # a queryset without collection, it must not be queried
+        field = ReferenceField(QuerySet(Author, None), search_fields='name')
+        self.assertEqual(field.search_fields, ('name', ))
+        field = copy.deepcopy(field)
+        author = Author(pk=ObjectId(), name='Douglas')
+        html = field.widget.render('author', author, {'id': 'id_author'})
+        self.assertTrue(str(author.pk) in html)
+        self.assertEqual(html.count('<option'), 2)
+
+
+class GenericReferenceFieldTest(SimpleTestCase):
+
+    def test_keys(self):
+        field = GenericReferenceField([Author])
+        pk = ObjectId()
+        self.assertEqual(field.to_key('Author:%s' % pk), (Author, pk))
+        self.assertEqual(field.to_key('Book:%s' % pk), None)
+        self.assertEqual(field.to_key('Author:invalid'), None)
+        self.assertEqual(field.prepare_value(Author(pk=pk)), 'Author:%s' % pk)
+
+    def test_clean_resolved(self):
+        field = copy.deepcopy(GenericReferenceField([Author]))
+        author = Author(pk=ObjectId())
+        missing = ObjectId()
+        # resolved in advance by the formset, no queries
+        field.resolved = {('Author', author.pk): author,
+                          ('Author', missing): None}
+        self.assertTrue(field.clean('Author:%s' % author.pk) is author)
+        self.assertRaises(ValidationError, field.clean, 'Author:%s' % missing)
+
+    def test_no_document_types(self):
+        # no document named in the data can be referenced
+        field = GenericReferenceField()
+        self.assertEqual(field.to_key('Author:%s' % ObjectId()), None)
+
+    def test_generated_without_choices(self):
+        class Link(mongoengine.Document):
+            target = mongoengine.GenericReferenceField()
+            targets = mongoengine.ListField(
+                mongoengine.GenericReferenceField())
+            author = mongoengine.GenericReferenceField(choices=[Author])
+
+        # fields that could never validate are left out of the form
+        form_class = documentform_factory(Link)
+        self.assertEqual(list(form_class.base_fields), ['author'])
+        generator = MongoFormFieldGenerator()
+        field = generator.generate(Link.target, document_types=[Author])
+        self.assertEqual(field.document_types, (Author, ))
+
+    def test_one_resolve_per_form(self):
+        authors = [Author(pk=ObjectId()) for i in range(3)]
+        form_class = type('LinkForm', (forms.Form, ), {
+            'first': GenericReferenceField([Author]),
+            'second': GenericReferenceField([Author]),
+            'many': ListField(GenericReferenceField([Author])),
+        })
+        form = form_class({'first': 'Author:%s' % authors[0].pk,
+                           'second': 'Author:%s' % authors[1].pk,
+                           'many_0': 'Author:%s' % authors[2].pk})
+        calls = []
+
+        def resolve(keys):
+            calls.append(sorted(pk for document, pk in keys))
+            return dict(((a._class_name, a.pk), a) for a in authors)
+
+        resolve_references = documents.resolve_generic_references
+        documents.resolve_generic_references = resolve
+        try:
+            documents._resolve_generic_references([form])
+        finally:
+            documents.resolve_generic_references = resolve_references
+        self.assertEqual(calls, [sorted(a.pk for a in authors)])
+        self.assertTrue(form.is_valid())
+        self.assertEqual(form.cleaned_data['many'], [authors[2]])
+        # the list field's contained field is copied for every form
+        self.assertTrue(form_class.base_fields['many'].contained_field
+                        .resolved is None)
+
+
+class Address(mongoengine.EmbeddedDocument):
+    street = mongoengine.StringField(required=True)
+    city = mongoengine.StringField()
+
+
+class Person(mongoengine.Document):
+    name = mongoengine.StringField()
+    address = mongoengine.EmbeddedDocumentField(Address)
+
+
+class PersonForm(DocumentForm):
+    class Meta:
+        document = Person
+        nested_fields = ['address']
+
+
+class NestedFormTest(SimpleTestCase):
+
+    def test_fields(self):
+        self.assertEqual(list(PersonForm.base_fields),
+                         ['name', 'address__street', 'address__city'])
+        # the embedded document is optional
+        self.assertFalse(PersonForm.base_fields['address__street'].required)
+
+    def test_validation(self):
+        form = PersonForm({'name': 'Arthur', 'address__city': 'London'})
+        self.assertFalse(form.is_valid())
+        self.assertEqual(list(form.errors), ['address__street'])
+        form = PersonForm({'name': 'Arthur'})
+        self.assertTrue(form.is_valid())
+        self.assertEqual(form.instance.address, None)
+
+    def test_changed_paths(self):
+        person = Person._from_son({
+            '_id': ObjectId(), 'name': 'Arthur',
+            'address': {'street': 'Country Lane', 'city': 'Cottington'},
+        })
+        form = PersonForm(instance=person)
+        self.assertEqual(form.initial['address__city'], 'Cottington')
+        form = PersonForm({'name': 'Arthur', 'address__street': 'Country Lane',
+                           'address__city': 'London'}, instance=person)
+        self.assertTrue(form.is_valid())
+        self.assertEqual(person._delta(), ({'address.city': 'London'}, {}))
+
+
+class CommentForm(EmbeddedDocumentForm):
+    class Meta:
+        document = Comment
+        embedded_field_name = 'comments'
+        guard_changes = True
+
+
+class EmbeddedChangesTest(SimpleTestCase):
+
+    def test_unchanged(self):
+        post = Post._from_son({'_id': ObjectId(),
+                               'comments': [{'text': 'a'}, {'text': 'b'}]})
+        form = CommentForm(post, {'text': 'b'}, position=1)
+        self.assertTrue(form.is_valid())
+        self.assertTrue(form._is_stored_instance(Post.comments))
+        # nothing changed, nothing is written
+        with QueryRecorder() as recorder:
+            form.save()
+        self.assertEqual(len(recorder), 0)
+        form = CommentForm(post, {'text': 'c'}, position=1)
+        self.assertTrue(form.is_valid())
+        self.assertEqual(form.instance._delta(), ({'text': 'c'}, {}))
+        self.assertEqual(_lookup_path(form._initial_son, 'text'), 'b')
+
+    def test_lookup_path(self):
+        son = {'a': [{'b': 1}], 'c': None}
+        self.assertEqual(_lookup_path(son, 'a.0.b'), 1)
+        self.assertEqual(_lookup_path(son, 'a.1.b'), None)
+        self.assertEqual(_lookup_path(son, 'c.d'), None)
+
+
+class Message(mongoengine.EmbeddedDocument):
+    subject = mongoengine.StringField(db_field='subj')
+
+
+class Mailbox(mongoengine.Document):
+    meta = {'app_label': 'mongodbforms', 'db_alias': 'mongomock'}
+
+    messages = mongoengine.ListField(mongoengine.EmbeddedDocumentField(Message),
+                                     db_field='msgs')
+
+
+class MessageForm(EmbeddedDocumentForm):
+    class Meta:
+        document = Message
+        embedded_field_name = 'messages'
+        guard_changes = True
+
+
+@unittest.skipIf(mongomock is None, 'needs mongomock')
+class EmbeddedSaveTest(SimpleTestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        super(EmbeddedSaveTest, cls).setUpClass()
+        mongoengine.connect('mongodbforms_tests', alias='mongomock',
+                            host='mongodb://localhost',
+                            mongo_client_class=mongomock.MongoClient)
+
+    @classmethod
+    def tearDownClass(cls):
+        mongoengine.disconnect(alias='mongomock')
+        super(EmbeddedSaveTest, cls).tearDownClass()
+
+    def setUp(self):
+        self.mailbox = Mailbox(messages=[Message(subject='first'),
+                                         Message(subject='second')]).save()
+        self.mailbox = Mailbox.objects.get(pk=self.mailbox.pk)
+
+    def stored(self):
+        return Mailbox._get_collection().find_one({'_id': self.mailbox.pk})
+
+    def test_renamed_fields(self):
+        form = MessageForm(self.mailbox, {'subject': 'changed'}, position=1)
+        self.assertTrue(form.is_valid())
+        form.save()
+        stored = self.stored()
+        self.assertEqual([m['subj'] for m in stored['msgs']],
+                         ['first', 'changed'])
+        self.assertFalse('messages' in stored)
+
+    def test_guard_conflict(self):
+        form = MessageForm(self.mailbox, {'subject': 'changed'}, position=0)
+        self.assertTrue(form.is_valid())
+        Mailbox._get_collection().update_one(
+            {'_id': self.mailbox.pk}, {'$set': {'msgs.0.subj': 'other'}})
+        self.assertRaises(OperationError, form.save)
+        self.assertEqual(self.stored()['msgs'][0]['subj'], 'other')
+
+
+class TextSearchQuerySet(QuerySet):
+    # mongomock has no $text, search anywhere in the name instead
+    def search_text(self, text, language=None):
+        return self.filter(name__contains=text)
+
+
+class Writer(mongoengine.Document):
+    meta = {'db_alias': 'mongomock', 'indexes': ['country'],
+            'queryset_class': TextSearchQuerySet}
+
+    name = mongoengine.StringField()
+    country = mongoengine.StringField()
+
+
+class Article(mongoengine.Document):
+    meta = {'db_alias': 'mongomock', 'indexes': ['$title'],
+            'auto_create_index': False}
+
+    title = mongoengine.StringField()
+
+
+@unittest.skipIf(mongomock is None, 'needs mongomock')
+class ReferenceSearchQueryTest(SimpleTestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        super(ReferenceSearchQueryTest, cls).setUpClass()
+        mongoengine.connect('mongodbforms_tests', alias='mongomock',
+                            host='mongodb://localhost',
+                            mongo_client_class=mongomock.MongoClient)
+        Writer.drop_collection()
+        for name in ('Douglas Adams', 'Doris Lessing', 'Dorothy Parker',
+                     'Terry Pratchett', 'Zadie Smith'):
+            Writer(name=name, country='uk').save()
+
+    @classmethod
+    def tearDownClass(cls):
+        Writer.drop_collection()
+        mongoengine.disconnect(alias='mongomock')
+        super(ReferenceSearchQueryTest, cls).tearDownClass()
+
+    def names(self, choices):
+        return [label for value, label in choices]
+
+    def test_paging(self):
+        field = ReferenceField(Writer.objects.order_by('name'),
+                               search_fields='name', page_size=2)
+        field.label_from_instance = lambda obj: obj.name
+        choices, has_more = field.search('Do')
+        self.assertEqual(self.names(choices),
+                         ['Doris Lessing', 'Dorothy Parker'])
+        self.assertTrue(has_more)
+        choices, has_more = field.search('Do', page=2)
+        self.assertEqual(self.names(choices), ['Douglas Adams'])
+        self.assertFalse(has_more)
+        choices, has_more = field.search('Do', page=3)
+        self.assertEqual((choices, has_more), ([], False))
+        # pages from the query string
+        self.assertEqual(field.search('Do', page='2'),
+                         field.search('Do', page=2))
+        for page in ('x', None, '', 0, -1):
+            self.assertEqual(field.search('Do', page=page),
+                             field.search('Do'))
+
+    def test_prefix_and_text_search(self):
+        field = ReferenceField(Writer.objects.order_by('name'),
+                               search_fields='name')
+        field.label_from_instance = lambda obj: obj.name
+        self.assertEqual(self.names(field.search('Adams')[0]), [])
+        self.assertEqual(self.names(field.search('Dor')[0]),
+                         ['Doris Lessing', 'Dorothy Parker'])
+        self.assertEqual(len(field.search('')[0]), 5)
+        field = ReferenceField(Writer.objects.order_by('name'),
+                               search_fields='$text')
+        field.label_from_instance = lambda obj: obj.name
+        self.assertEqual(self.names(field.search('Adams')[0]),
+                         ['Douglas Adams'])
+
+    def test_search_fields_from_threshold(self):
+        generator = MongoFormFieldGenerator()
+        self.assertEqual(generator.get_reference_search_fields(Writer), None)
+        generator.reference_search_threshold = 10
+        self.assertEqual(generator.get_reference_search_fields(Writer), None)
+        generator.reference_search_threshold = 2
+        # the indexed string field
+        self.assertEqual(generator.get_reference_search_fields(Writer),
+                         ('country', ))
+        form_field = generator.generate(
+            mongoengine.ReferenceField(Writer, required=False))
+        self.assertEqual(form_field.search_fields, ('country', ))
+        self.assertTrue(form_field.widget.__class__ is
+                        ReferenceField.search_widget)
+        Article.drop_collection()
+        for title in ('a', 'b', 'c'):
+            Article(title=title).save()
+        try:
+            self.assertEqual(generator.get_reference_search_fields(Article),
+                             '$text')
+        finally:
+            Article.drop_collection()
@@ -1,9 +1,10 @@
-from collections import defaultdict
+import sys
+import threading
+from collections import defaultdict, OrderedDict
 
 from django.conf import settings
 
-from mongodbforms.documentoptions import DocumentMetaWrapper, LazyDocumentMetaWrapper
-from mongodbforms.fieldgenerator import MongoDefaultFormFieldGenerator
+from mongodbforms.documentoptions import get_document_meta, is_document_meta
 
 try:
     from django.utils.module_loading import import_by_path
@@ -46,12 +47,28 @@ except ImportError:
 def load_field_generator():
     if hasattr(settings, 'MONGODBFORMS_FIELDGENERATOR'):
         return import_by_path(settings.MONGODBFORMS_FIELDGENERATOR)
+    # imported here, mongodbforms.fields uses this module
+    from mongodbforms.fieldgenerator import MongoDefaultFormFieldGenerator
     return MongoDefaultFormFieldGenerator
 
 
+_default_field_generator = []
+
+
+def get_default_field_generator():
+    """
+    Returns the project wide field generator. It is loaded on first use
+    instead of at import time, so importing mongodbforms doesn't need
+    configured settings.
+    """
+    if not _default_field_generator:
+        _default_field_generator.append(load_field_generator())
+    return _default_field_generator[0]
+
+
 def init_document_options(document):
-    if not isinstance(document._meta, (DocumentMetaWrapper, LazyDocumentMetaWrapper)):
-        document._meta = DocumentMetaWrapper(document)
+    if not is_document_meta(document._meta):
+        document._meta = get_document_meta(document)
     # Workaround for Django 1.7+
     document._deferred = False
     # FIXME: Wrong implementation for Relations (https://github.com/django/django/blob/master/django/db/models/base.py#L601)
@@ -60,7 +77,54 @@ def init_document_options(document):
 
 
 def get_document_options(document):
-    return DocumentMetaWrapper(document)
+    return get_document_meta(document)
+
+
+class LRUCache(object):
+    """
+    A small thread-safe least recently used cache. Holds at most ``maxsize``
+    entries.
+    """
+    def __init__(self, maxsize=256):
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value = self._data.pop(key)
+            except KeyError:
+                return default
+            self._data[key] = value
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = value
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+
+def make_cache_key(*args):
+    """
+    Builds a hashable cache key from factory arguments. Lists become tuples.
+    Returns None if an argument can't be hashed.
+    """
+    key = tuple(tuple(a) if isinstance(a, list) else a for a in args)
+    try:
+        hash(key)
+    except TypeError:
+        return None
+    return key
 
 
 def format_mongo_validation_errors(validation_exception):
@@ -106,6 +170,18 @@ def format_mongo_validation_errors(validation_exception):
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 
+PY3 = sys.version_info[0] == 3
+
+if PY3:
+    string_types = str,
+    integer_types = int,
+    text_type = str
+else:
+    string_types = basestring,
+    integer_types = (int, long)
+    text_type = unicode
+
+
 def with_metaclass(meta, *bases):
     """Create a base class with a metaclass."""
     return meta("NewBase", bases, {})
@@ -2,7 +2,8 @@ import copy
 
 from django.forms.widgets import (Widget, Media, TextInput,
                                   SplitDateTimeWidget, DateInput, TimeInput,
-                                  MultiWidget, HiddenInput)
+                                  MultiWidget, HiddenInput, Select,
+                                  SelectMultiple)
 from django.utils.safestring import mark_safe
 from django.core.validators import EMPTY_VALUES
 if (django.get_version() < '1.8'):
@@ -57,7 +58,7 @@ class BaseContainerWidget(Widget):
 
     def __deepcopy__(self, memo):
         obj = super(BaseContainerWidget, self).__deepcopy__(memo)
-        obj.data_widget = copy.deepcopy(self.data_widget)
+        obj.data_widget = copy.deepcopy(self.data_widget, memo)
         return obj
 
 
@@ -168,7 +169,7 @@ class MapWidget(BaseContainerWidget):
 
     def __deepcopy__(self, memo):
         obj = super(MapWidget, self).__deepcopy__(memo)
-        obj.key_widget = copy.deepcopy(self.key_widget)
+        obj.key_widget = copy.deepcopy(self.key_widget, memo)
         return obj
 
 
@@ -179,3 +180,34 @@ class HiddenMapWidget(MapWidget):
         data_widget = HiddenInput()
         super(MapWidget, self).__init__(data_widget, attrs)
         self.key_widget = HiddenInput()
+
+
+class ReferenceSearchMixin(object):
+    """
+    Renders only the options of the selected documents of a reference field
+    in search mode. Other candidates are fetched page by page with
+    ``ReferenceField.search``, e.g. by an autocomplete script that reads the
+    ``data-search-url`` attribute.
+    """
+    def __init__(self, attrs=None, search_url=None):
+        super(ReferenceSearchMixin, self).__init__(attrs)
+        self.search_url = search_url
+        # set by the form field, returns the choices for the selected values
+        self.selected_choices = None
+
+    def render(self, name, value, attrs=None, *args, **kwargs):
+        if self.selected_choices is not None:
+            self.choices = self.selected_choices(value)
+        attrs = dict(attrs or {})
+        if self.search_url:
+            attrs['data-search-url'] = self.search_url
+        return super(ReferenceSearchMixin, self).render(name, value, attrs,
+                                                        *args, **kwargs)
+
+
+class ReferenceSearchSelect(ReferenceSearchMixin, Select):
+    pass
+
+
+class ReferenceSearchSelectMultiple(ReferenceSearchMixin, SelectMultiple):
+    pass